@@ -10,9 +10,11 @@ from werkzeug.routing import BaseConverter
 
 import psycopg2
 from psycopg2.extras import Json
-from psycopg2.pool import ThreadedConnectionPool
 
 from .i18n import i18n_init
+from .pool import pool_init
+from .audit import audit_init
+from .sessions import sessions_init
 from .aws import ec2_metadata
 from .version import __version__
 from .flask import config_file, load_config
@@ -49,7 +51,9 @@ def create_app(instance_path="."):
                 sys.exit(f"Database version does not match application version")
     
     psycopg2.extensions.register_adapter(dict, Json)
-    app.extensions["connction_pool"] = ThreadedConnectionPool(1, 10, dsn=config["DB_URI"])
+    pool_init(app)
+    audit_init(app)
+    sessions_init(app)
     
     class TagDate(JSONTag):
         __slots__ = ('serializer',)
@@ -14,6 +14,7 @@ from .views import app
 from ..logic import perform_edit, perform_delete, perform_restore
 from ..i18n import __ as _
 from ..view_helpers import log_table
+from ..paging import Paginator
 from .forms import LocationForm, NameBarcodeForm
 from ..generic_views import audit_view
 
@@ -175,17 +176,19 @@ def location_list(location_id):
             breadcrumbs.append((name, url_for(".location_list", location_id=row_id), row_id == location_id))
             location_id = row_id
         
-        sql = """SELECT location.id, location.name, location.locationtype, location.deleted, coalesce(locationmodel.name, '')
-                 FROM location
-                 LEFT OUTER JOIN locationmodel ON location.locationmodel_id = locationmodel.id
-                 WHERE location.parent_id = %(location_id)s AND location.movable = 'fixed';"""
-        body = []
-        cur.execute(sql, {"location_id": location_id})
-        for row_id, name, locationtype, deleted, model in cur:
-            body.append(((_(locationtype),
-                          name,
-                          model),
-                         {"id": row_id, "deleted": deleted}))
+    sql = """SELECT location.id, location.name, location.locationtype, location.deleted, coalesce(locationmodel.name, '') AS model
+             FROM location
+             LEFT OUTER JOIN locationmodel ON location.locationmodel_id = locationmodel.id
+             WHERE location.parent_id = %(location_id)s AND location.movable = 'fixed'"""
+    paging = Paginator(sql, {"location_id": location_id},
+                       columns=("locationtype", "name", "model"),
+                       searchable=("locationtype", "name", "model"),
+                       default="locationtype",
+                       key="name")
+    body = (((_(locationtype),
+              name,
+              model),
+             {"id": row_id, "deleted": deleted}) for row_id, name, locationtype, deleted, model in paging.rows())
     
     head = (_("Type"), _("Name"), _("Model"))
     actions = ({"name": _("View"), "href": url_for(".location_list", location_id=0)},
@@ -195,6 +198,6 @@ def location_list(location_id):
                {"name": _("Log"), "href": url_for(".location_log", location_id=0)})
     
     return render_page("table.html",
-                       table={"head": head, "body": sorted(body), "actions": actions, "new": url_for(".new_location", location_id=location_id)},
+                       table={"head": head, "body": body, "actions": actions, "new": url_for(".new_location", location_id=location_id), "paging": paging},
                        breadcrumbs=breadcrumbs,
                        buttons={"back": (_("Back"), url_for(".editmenu"))})
@@ -25,8 +25,8 @@ def pathologysite_log(pathologysite_id):
 
         
 
-@app.route("/pathologysites/new", defaults={"pathologysite_id": None}, methods=["GET", "POST"])
-@app.route("/pathologysites/<int:pathologysite_id>/edit", methods=["GET", "POST"])
+@app.route("/pathologysites/new", defaults={"pathologysite_id": None}, methods=["GET", "POST"], retries=3)
+@app.route("/pathologysites/<int:pathologysite_id>/edit", methods=["GET", "POST"], retries=3)
 def edit_pathologysite(pathologysite_id):
     with Transaction() as trans:
         with trans.cursor() as cur:
@@ -7,7 +7,8 @@ from psycopg2.errors import UniqueViolation
 from psycopg2.extras import execute_batch
 
 from ..utils import Cursor, Transaction, dict_from_select, audit_log, keyvals_from_form
-from ..flask import render_page, valid_roles, abort
+from ..paging import Paginator
+from ..flask import render_page, stream_page, valid_roles, abort
 from ..auth import send_setpassword_email
 from ..i18n import _, Date
 from ..forms import ActionForm
@@ -90,7 +91,7 @@ def edit_userprojects(users_id):
                     values = [{"project_id": project_id, "users_id": users_id} for project_id in inserted_projects]
                     execute_batch(cur, sql, values)
                     keyvals = {form.project._label: [projects[project_id] for project_id in inserted_projects]}
-                    audit_log(cur, "Added", "User", name, keyvals, "", ("users", users_id))
+                    audit_log(cur, "Added", "User", name, keyvals, "", ("users", users_id), deferred=True)
                     
                 deleted_projects = list(old_projects - new_projets)
                 if deleted_projects:
@@ -99,7 +100,7 @@ def edit_userprojects(users_id):
                     values = [{"project_id": project_id, "users_id": users_id} for project_id in deleted_projects]
                     execute_batch(cur, sql, values)
                     keyvals = {form.project._label: [projects[project_id] for project_id in deleted_projects]}
-                    audit_log(cur, "Removed", "User", name, keyvals, "", ("users", users_id))
+                    audit_log(cur, "Removed", "User", name, keyvals, "", ("users", users_id), deferred=True)
     
     buttons={"submit": (_("Save"), url_for(".edit_userprojects", users_id=users_id)),
              "back": (_("Cancel"), url_for(".list_users"))}
@@ -152,7 +153,7 @@ def edit_userroles(users_id):
                     values = [{"name": role, "users_id": users_id} for role in inserted_roles]
                     execute_batch(cur, sql, values)
                     keyvals = {form.role._label: inserted_roles}
-                    audit_log(cur, "Added", "User", name, keyvals, "", ("users", users_id))
+                    audit_log(cur, "Added", "User", name, keyvals, "", ("users", users_id), deferred=True)
                     
                 deleted_roles = list(old_roles - new_roles)
                 if deleted_roles:
@@ -161,7 +162,7 @@ def edit_userroles(users_id):
                     values = [{"name": role, "users_id": users_id} for role in deleted_roles]
                     execute_batch(cur, sql, values)
                     keyvals = {form.role._label: deleted_roles}
-                    audit_log(cur, "Removed", "User", name, keyvals, "", ("users", users_id))
+                    audit_log(cur, "Removed", "User", name, keyvals, "", ("users", users_id), deferred=True)
     
     buttons={"submit": (_("Save"), url_for(".edit_userroles", users_id=users_id)),
              "back": (_("Cancel"), url_for(".list_users"))}
@@ -235,21 +236,20 @@ def new_user():
 
 @app.route("/users")
 def list_users():
-    with Cursor() as cur:
-        body = []
-        sql = """SELECT users.id, users.fullname, users.email, users.last_login_datetime, users.deleted, array_remove(array_agg(role_users.name), NULL)
-                 FROM users
-                 LEFT OUTER JOIN role_users ON users.id = role_users.users_id AND role_users.name IN %(valid_roles)s
-                 GROUP BY users.id
-                 ORDER BY users.surname, users.forename;"""    
-        cur.execute(sql, {"valid_roles": valid_roles()})
-        for users_id, fullname, email, last_login_datetime, deleted, roles in cur:
-            body.append(([fullname,
-                          email,
-                          ", ".join(sorted(_(role) for role in roles)),
-                          Date(last_login_datetime)],
-                         {"id": users_id,
-                          "deleted": deleted}))
+    sql = """SELECT users.id, users.fullname, users.email, users.last_login_datetime, users.deleted, array_remove(array_agg(role_users.name), NULL) AS roles
+             FROM users
+             LEFT OUTER JOIN role_users ON users.id = role_users.users_id AND role_users.name IN %(valid_roles)s
+             GROUP BY users.id"""    
+    paging = Paginator(sql, {"valid_roles": valid_roles()},
+                       columns=("fullname", "email", None, None),
+                       searchable=("fullname", "email"),
+                       default="fullname")
+    body = (([fullname,
+              email,
+              ", ".join(sorted(_(role) for role in roles)),
+              Date(last_login_datetime)],
+             {"id": users_id,
+              "deleted": deleted}) for users_id, fullname, email, last_login_datetime, deleted, roles in paging.rows())
 
     head = (_("Name"), _("Email"), _("Roles"), _("Last Login"))
     actions = ({"name": _("Edit"), "href": url_for(".edit_user", users_id=0)},
@@ -258,7 +258,7 @@ def list_users():
                {"name": _("Reset Password"), "href": url_for(".action_user", users_id=0), "class": "!deleted", "method": "POST"},
                {"name": _("Log"), "href": url_for(".user_log", users_id=0)})
 
-    return render_page("table.html",
-                       table={"head": head, "body": body, "actions": actions, "new": url_for(".new_user")},
+    return stream_page("table.html",
+                       table={"head": head, "body": body, "actions": actions, "new": url_for(".new_user"), "paging": paging},
                        title=_("Users"),
                        buttons=())
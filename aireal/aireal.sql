@@ -12,6 +12,17 @@ CREATE TABLE version (
 
 
 
+-- Server side sessions, see sessions.py. Unlogged as sessions are disposable and written often.
+CREATE UNLOGGED TABLE websession (
+    id VARCHAR NOT NULL,
+    data VARCHAR NOT NULL,
+    expires TIMESTAMP WITH TIME ZONE NOT NULL,
+    CONSTRAINT pk_websession PRIMARY KEY (id)
+    );
+CREATE INDEX ix_websession_expires ON websession (expires);
+
+
+
 CREATE TABLE users (
     id INTEGER GENERATED BY DEFAULT AS IDENTITY, 
     name VARCHAR GENERATED ALWAYS AS (LEFT(forename, 1) || '.' || surname) STORED, 
@@ -61,8 +72,8 @@ CREATE TABLE editrecord (
     CONSTRAINT pk_editrecord PRIMARY KEY (id), 
     CONSTRAINT fk_editrecord_users_id_user FOREIGN KEY (users_id) REFERENCES users (id)
     );
-CREATE INDEX ix_editrecord_tablename ON editrecord (tablename);
-CREATE INDEX ix_editrecord_row_id ON editrecord (row_id);
+-- Matches log_table which filters on tablename, row_id and orders by edit_datetime, id
+CREATE INDEX ix_editrecord_tablename_row_id ON editrecord (tablename, row_id, edit_datetime, id);
 
 
 
@@ -105,7 +116,7 @@ CREATE TABLE auditlink (
     audittrail_id INTEGER NOT NULL,
     tablename VARCHAR NOT NULL,
     row_id INTEGER NOT NULL,
-    CONSTRAINT pk_auditlink PRIMARY KEY (tablename, row_id, audittrail_id),
+    CONSTRAINT pk_auditlink PRIMARY KEY (tablename, row_id, audittrail_id), -- also serves lookups by row
     CONSTRAINT fk_auditlink_audittrail_id_audittrail FOREIGN KEY (audittrail_id) REFERENCES audittrail (id)
     );
 CREATE INDEX ix_auditlink_audittrail ON auditlink (audittrail_id);
@@ -0,0 +1,509 @@
+import os
+import io
+import csv
+import json
+import fcntl
+import time
+import queue
+import collections
+import atexit
+import threading
+from datetime import datetime, timezone
+import pdb
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+
+from flask import current_app, has_app_context, session, request
+
+from .pool import checkout, checkin
+
+__all__ = ["AuditSink",
+           "audit_init",
+           "audit_sink",
+           "record_event"]
+
+
+
+EDITRECORD_COLUMNS = ("tablename", "row_id", "action", "details", "users_id", "ip_address", "edit_datetime")
+AUDITTRAIL_COLUMNS = ("id", "action", "target", "name", "keyvals", "format_string", "users_id", "ip_address", "datetime")
+
+
+
+def _copy(cur, tablename, columns, rows, nullable=()):
+    """ COPY rows into tablename. Rows are sent as csv with every string
+        quoted so that the only unquoted value, the empty string written
+        for None, is read as NULL except that quoted empty strings are
+        also read as NULL in the nullable columns.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows(rows)
+    buf.seek(0)
+    force_null = ", FORCE_NULL ({})".format(", ".join(nullable)) if nullable else ""
+    cur.copy_expert(f"COPY {tablename} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv{force_null});", buf)
+
+
+
+def write_events(cur, events):
+    """ Write a batch of sink events with one COPY per table. Audittrail
+        ids are drawn from its sequence in a single round trip beforehand
+        so that the auditlink rows can be copied alongside them.
+
+    Args:
+        cur:
+            Postgresql cursor object to perform copy with.
+        events:
+            List of (kind, row) where kind is "editrecord" or "audittrail".
+
+    Returns:
+        None.
+    """
+    editrecords = []
+    audittrails = []
+    for kind, row in events:
+        if kind == "editrecord":
+            tablename, row_id, action, details, users_id, ip_address, edit_datetime = row
+            editrecords.append((tablename, row_id, action, json.dumps(details, default=str), users_id, ip_address, edit_datetime))
+        else:
+            audittrails.append(row)
+
+    if editrecords:
+        _copy(cur, "editrecord", EDITRECORD_COLUMNS, editrecords, nullable=("users_id", "ip_address"))
+
+    if audittrails:
+        cur.execute("SELECT nextval(pg_get_serial_sequence('audittrail', 'id')) FROM generate_series(1, %(n)s);", {"n": len(audittrails)})
+        trails = []
+        links = []
+        for (audittrail_id,), row in zip(cur.fetchall(), audittrails):
+            action, target, name, keyvals, format_string, users_id, ip_address, datetime_, entry_links = row
+            trails.append((audittrail_id, action, target, name, json.dumps(keyvals, default=str), format_string, users_id, ip_address, datetime_))
+            links.extend((audittrail_id, tablename, row_id) for tablename, row_id in entry_links)
+        _copy(cur, "audittrail", AUDITTRAIL_COLUMNS, trails, nullable=("users_id", "ip_address"))
+        if links:
+            _copy(cur, "auditlink", ("audittrail_id", "tablename", "row_id"), links)
+
+
+
+def _read_spool(f):
+    """ List of (seq, event) of every event in an open spool file after its
+        last checkpoint.
+    """
+    pending = []
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError: # Torn final line
+            continue
+        if "checkpoint" in record:
+            pending = [(seq, event) for seq, event in pending if seq > record["checkpoint"]]
+        else:
+            pending.append((record["seq"], (record["kind"], record["row"])))
+    return pending
+
+
+
+class AuditSink(object):
+    """ Writes audittrail and editrecord rows from a background thread in
+        batches using COPY so that requests do not pay for them.
+
+    Events are accepted in process onto a bounded queue. When the queue is
+    full the producer writes its event synchronously itself, which
+    throttles producers to the speed of the database rather than dropping
+    events or blocking indefinitely.
+
+    Every queued event is also appended to a local spool file. After each
+    batch is committed a checkpoint is appended and the file is truncated
+    whenever the queue drains. Events in the spool after the last
+    checkpoint are replayed when a sink is next started, therefore no
+    event is lost if the process dies. Delivery is at least once, a crash
+    between a commit and its checkpoint replays that batch. The spool is
+    flushed to the operating system but not fsynced so a crash of the host
+    itself may lose recent events.
+
+    Each process spools to its own file, spool_path followed by its pid,
+    and holds an exclusive lock on it for as long as the sink runs. Several
+    processes may therefore share an instance folder. On starting, a sink
+    adopts and replays every spool that no other process holds locked, ie
+    those left by processes that have died, whatever their pid.
+
+    The unwritten events in the spool are limited to half of spool_size
+    bytes. Once the limit is reached, eg if the database is unavailable for
+    a long time, further events are diverted to the dead letter file
+    rather than queued, so that the spool cannot fill the disk. When the
+    file itself reaches spool_size it is compacted, rewriting it with only
+    the unwritten events.
+
+    Connection and other transient errors are retried until they succeed.
+    An event that fails for any other reason, eg a constraint violation, is
+    logged and appended to the dead letter file spool_path.dead, shared by
+    every process, rather than being retried, so that it cannot block the
+    events behind it.
+
+    Args:
+        dsn:
+            Database connection string. The worker uses its own connection
+            rather than one from the request pool.
+        spool_path:
+            Path of the spool file, to which the pid is appended.
+        maxsize:
+            Maximum number of queued events.
+        spool_size:
+            Maximum size of the spool file in bytes.
+        batch_size:
+            Maximum number of events per COPY.
+        interval:
+            Maximum seconds to wait to fill a batch.
+        logger:
+            Logger for database errors.
+    """
+    def __init__(self, dsn, spool_path, maxsize=10000, spool_size=64*1024*1024, batch_size=500, interval=1.0, logger=None):
+        self.dsn = dsn
+        self.dead_letter_path = f"{spool_path}.dead"
+        self.spool_path = f"{spool_path}.{os.getpid()}"
+        self.spool_size = spool_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.logger = logger
+
+        # Replayed events are always accepted even if there are more than
+        # maxsize or they exceed the spool limit.
+        self._spool, pending = self._recover(spool_path)
+        self._queue = queue.Queue(max(maxsize, len(pending)))
+        self._lock = threading.Lock()
+        self._conn = None
+        self._metrics = {"queued": 0,
+                         "written": 0,
+                         "batches": 0,
+                         "synchronous": 0,
+                         "errors": 0,
+                         "dead_lettered": 0,
+                         "diverted": 0,
+                         "compactions": 0,
+                         "replayed": 0}
+
+        # Sizes of the lines of the unwritten events in the spool, in seq
+        # order, to track the unwritten bytes without reading the file.
+        self._sizes = collections.deque((seq, len(self._spool_line(seq, event))) for seq, event in enumerate(pending))
+        self._pending_size = sum(size for seq, size in self._sizes)
+        self._spool_size = self._pending_size
+        self._seq = len(pending)
+        for seq, event in enumerate(pending):
+            self._queue.put_nowait((seq, event))
+        self._metrics["replayed"] = len(pending)
+
+        self._thread = threading.Thread(target=self._run, name="audit-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+
+    @staticmethod
+    def _spool_line(seq, event):
+        return json.dumps({"seq": seq, "kind": event[0], "row": event[1]}, default=str) + "\n"
+
+
+    def _replace_spool(self, events):
+        # The new spool is locked before it replaces the old one so that no
+        # other process can adopt it in between.
+        tmp_path = f"{self.spool_path}.tmp"
+        spool = open(tmp_path, "w")
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        for seq, event in events:
+            spool.write(self._spool_line(seq, event))
+        spool.flush()
+        os.fsync(spool.fileno())
+        os.replace(tmp_path, self.spool_path)
+        return spool
+
+
+    def _recover(self, spool_path):
+        # The events after the last checkpoint of every orphaned spool, ie
+        # one that is not locked, including one left by an earlier process
+        # with the same pid, are rewritten to a new spool which atomically
+        # replaces this process's. The orphans are held locked until they
+        # have been removed, therefore if the process dies during recovery
+        # the original spools are still intact.
+        directory, base = os.path.split(spool_path)
+        orphans = []
+        pending = []
+        for filename in sorted(os.listdir(directory or ".")):
+            suffix = filename[len(base) + 1:]
+            if filename != base and not (filename.startswith(f"{base}.") and suffix.isdigit()):
+                continue
+            f = open(os.path.join(directory, filename))
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: # Spool of a running process
+                f.close()
+                continue
+            if os.fstat(f.fileno()).st_nlink == 0: # Already adopted by another process
+                f.close()
+                continue
+            pending.extend(event for seq, event in _read_spool(f))
+            orphans.append((filename, f))
+
+        spool = self._replace_spool(enumerate(pending))
+        for filename, f in orphans:
+            if filename != os.path.basename(self.spool_path):
+                os.remove(f.name)
+            f.close()
+        return spool, pending
+
+
+    def _compact(self):
+        # Called with the lock held.
+        self._spool.flush()
+        with open(self.spool_path) as f:
+            pending = _read_spool(f)
+        spool = self._replace_spool(pending)
+        self._spool.close()
+        self._spool = spool
+        self._spool_size = self._pending_size
+        self._metrics["compactions"] += 1
+
+
+    def _enqueue(self, event):
+        # Must not block while holding the lock as the worker takes it to
+        # truncate the spool. Returns False, without queueing the event, if
+        # the spool is full.
+        with self._lock:
+            line = self._spool_line(self._seq, event)
+            if self._pending_size + len(line) > self.spool_size // 2:
+                self._metrics["diverted"] += 1
+                return False
+            self._queue.put_nowait((self._seq, event))
+            if self._spool_size + len(line) > self.spool_size:
+                self._compact()
+            self._spool.write(line)
+            self._spool.flush()
+            self._sizes.append((self._seq, len(line)))
+            self._pending_size += len(line)
+            self._spool_size += len(line)
+            self._seq += 1
+            self._metrics["queued"] += 1
+        return True
+
+
+    def put(self, kind, row):
+        """ Queue an event for writing, or write it immediately if the
+            queue is full, or divert it to the dead letter file if the
+            spool is full.
+        """
+        try:
+            if not self._enqueue((kind, row)):
+                self._dead_letter((kind, row), "Spool full")
+        except queue.Full:
+            with self._lock:
+                self._metrics["synchronous"] += 1
+            conn = checkout(ISOLATION_LEVEL_READ_COMMITTED, readonly=False)
+            try:
+                with conn.cursor() as cur:
+                    write_events(cur, [(kind, row)])
+                conn.commit()
+            finally:
+                checkin(conn)
+
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.error(message)
+
+
+    def _run(self):
+        while True:
+            seq, event = self._queue.get()
+            if event is None:
+                return
+            batch = [(seq, event)]
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    seq, event = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                batch.append((seq, event))
+
+            # The worker must survive anything, otherwise nothing drains
+            # the queue until the process is restarted.
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._log(f"Audit sink worker error: {e!r}")
+            if stop:
+                return
+
+
+    def _write_events(self, events):
+        # Connection and transient errors are retried indefinitely. Any
+        # other error is permanent for at least one event, therefore the
+        # events are split in half until the failing ones are isolated
+        # and dead lettered so that they cannot block the sink.
+        delay = 0.5
+        while True:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = psycopg2.connect(self.dsn)
+                with self._conn:
+                    with self._conn.cursor() as cur:
+                        write_events(cur, events)
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                with self._lock:
+                    self._metrics["errors"] += 1
+                self._log(f"Audit sink write failed, retrying in {delay}s: {e}")
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            except Exception as e:
+                with self._lock:
+                    self._metrics["errors"] += 1
+                if len(events) == 1:
+                    self._dead_letter(events[0], e)
+                    return
+                middle = len(events) // 2
+                self._write_events(events[:middle])
+                self._write_events(events[middle:])
+                return
+
+
+    def _dead_letter(self, event, error):
+        kind, row = event
+        self._log(f"Audit sink discarded {kind} event {row!r}: {error}")
+        with self._lock:
+            self._metrics["dead_lettered"] += 1
+            with open(self.dead_letter_path, "a") as f:
+                # Shared by every process.
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps({"kind": kind, "row": row, "error": str(error)}, default=str) + "\n")
+
+
+    def _write(self, batch):
+        self._write_events([event for seq, event in batch])
+
+        with self._lock:
+            self._metrics["batches"] += 1
+            self._metrics["written"] += len(batch)
+            if self._queue.empty():
+                self._spool.truncate(0)
+                self._spool.seek(0)
+                self._sizes.clear()
+                self._pending_size = 0
+                self._spool_size = 0
+            else:
+                line = json.dumps({"checkpoint": batch[-1][0]}) + "\n"
+                self._spool.write(line)
+                self._spool.flush()
+                self._spool_size += len(line)
+                while self._sizes and self._sizes[0][0] <= batch[-1][0]:
+                    self._pending_size -= self._sizes.popleft()[1]
+
+
+    def close(self, timeout=10):
+        """ Write out the queued events and stop the worker. Anything still
+            queued after timeout seconds remains in the spool, to be
+            replayed by the next sink started. An empty spool is removed.
+        """
+        if self._thread.is_alive():
+            try:
+                self._queue.put((None, None), timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        if self._conn is not None:
+            self._conn.close()
+        if not self._spool.closed:
+            with self._lock:
+                if self._spool_size == 0:
+                    os.remove(self.spool_path)
+                self._spool.close()
+
+
+    def stats(self):
+        """ Returns a dict of the current queue length and cumulative
+            counters.
+        """
+        with self._lock:
+            return {"pending": self._queue.qsize(), **self._metrics}
+
+
+
+def audit_init(app):
+    """ Start the audit sink if enabled by the AUDIT_SINK config key. The
+        sink is further configured with the following optional keys:
+            AUDIT_SINK_QUEUE_SIZE: Maximum queued events (10000).
+            AUDIT_SINK_BATCH_SIZE: Maximum events per write (500).
+            AUDIT_SINK_INTERVAL: Maximum seconds to wait to fill a batch (1).
+            AUDIT_SINK_SPOOL: Spool file path, to which each process
+                appends its pid (instance_path/audit.spool).
+            AUDIT_SINK_SPOOL_SIZE: Maximum bytes of each spool file (64MiB),
+                see AuditSink.
+    """
+    config = app.config
+    if not config.get("AUDIT_SINK"):
+        return
+
+    spool_path = config.get("AUDIT_SINK_SPOOL") or os.path.join(app.instance_path, "audit.spool")
+    app.extensions["audit_sink"] = AuditSink(config["DB_URI"],
+                                             spool_path,
+                                             maxsize=config.get("AUDIT_SINK_QUEUE_SIZE", 10000),
+                                             spool_size=config.get("AUDIT_SINK_SPOOL_SIZE", 64*1024*1024),
+                                             batch_size=config.get("AUDIT_SINK_BATCH_SIZE", 500),
+                                             interval=config.get("AUDIT_SINK_INTERVAL", 1.0),
+                                             logger=app.logger)
+
+
+
+def audit_sink():
+    """ Returns the application's AuditSink or None if it is not enabled.
+    """
+    if has_app_context():
+        return current_app.extensions.get("audit_sink")
+
+
+
+def record_event(tablename, row_id, action, details={}, users_id=None, ip_address=None):
+    """ Record an editrecord event that is not part of any write, eg a
+        view. Written by the audit sink if enabled, otherwise immediately.
+
+    Args:
+        tablename:
+            Table of the affected row.
+        row_id:
+            id of the affected row.
+        action:
+            Action performed, verb, past tense eg Viewed.
+        details:
+            Dict of further details.
+        users_id:
+            id of user performing action. Only needed if action is not performed within request context.
+        ip_address:
+            ip address of user performing action. Only needed if action is not performed within request context.
+
+    Returns:
+        None.
+    """
+    row = (tablename,
+           row_id,
+           action,
+           details,
+           users_id or session.get("id"),
+           ip_address or request.remote_addr,
+           datetime.now(timezone.utc).isoformat())
+
+    sink = audit_sink()
+    if sink is not None:
+        sink.put("editrecord", row)
+    else:
+        conn = checkout(ISOLATION_LEVEL_READ_COMMITTED, readonly=False)
+        try:
+            with conn.cursor() as cur:
+                write_events(cur, [("editrecord", row)])
+            conn.commit()
+        finally:
+            checkin(conn)
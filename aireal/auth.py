@@ -32,7 +32,7 @@ from .forms import (LoginForm,
                    ChangePasswordForm,
                    TwoFactorForm)
 from .utils import Transaction, Cursor
-from .flask import Blueprint, render_page, render_template, abort, sign_token, valid_roles
+from .flask import Blueprint, render_page, render_template, abort, sign_token, valid_roles, role_navbar
 from .aws import sendmail
 from .i18n import _, locale_from_headers, Locale
 
@@ -98,7 +98,7 @@ def hotp(secret, counter, token_length=6):
 def root():
     if "id" in session:
         try:
-            return redirect(Blueprint.navbars[session["role"]]()[0]["href"])
+            return redirect(role_navbar(session["role"])[0]["href"])
         except (KeyError, IndexError):
             return render_page("base.html")
     else:
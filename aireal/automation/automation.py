@@ -6,14 +6,13 @@ from datetime import datetime, timedelta, timezone
 from time import sleep
 from contextlib import closing
 
-import boto3
 from botocore.exceptions import ClientError
 
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
 
 from aireal.flask import config_file, load_config
-from aireal.aws import ec2_metadata
+from aireal.aws import ec2_metadata, boto3_client
 
 import pdb
 
@@ -98,8 +97,8 @@ def main():
         sys.exit("DB_URI not found within configuration file")
     config.update(ec2_metadata())
     
+    client = boto3_client("ec2", region_name=config.get("AWS_REGION"))
     while True:
-        client = boto3.client("ec2")
         with closing(psycopg2.connect(config["DB_URI"])) as conn:
             conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, autocommit=True)
             with conn.cursor() as cur:
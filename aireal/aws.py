@@ -1,4 +1,7 @@
-from datetime import datetime, timedelta
+import os
+import time
+import threading
+from datetime import datetime, timedelta, timezone
 import requests
 import pdb
 import json
@@ -19,10 +22,13 @@ from werkzeug import exceptions
 from .i18n import _
 
 __all__ = [
+    "boto3_client",
     "ec2_metadata",
     "s3_sign_url",
     "cloudfront_sign_url",
+    "cloudfront_sign_urls",
     "cloudfront_sign_cookies",
+    "cloudfront_cached_cookies",
     "sendmail",
     "list_objects",
     "object_exists",
@@ -32,6 +38,53 @@ __all__ = [
 # Caching to reduce need for repeated api calls. They
 task_definitions = {}
 preferred_subnet = ""
+private_keys = {}
+signed_cookies = {}
+clients = {}
+clients_lock = threading.Lock()
+
+CLIENT_CONFIG = {"max_pool_connections": 32,
+                 "connect_timeout": 5,
+                 "read_timeout": 60,
+                 "retries": {"max_attempts": 5, "mode": "standard"}}
+
+
+
+def boto3_client(service, region_name=None, **config):
+    """ Returns a boto3 client that is shared by every thread in the
+        process. Building a client resolves endpoints and credentials and
+        is slow, whereas clients themselves are thread safe, therefore one
+        is created per service, region and config and then reused.
+    
+    The endpoint may be redirected to a local stand-in such as moto or
+    MinIO with the standard AWS_ENDPOINT_URL environment variables.
+    
+    Args:
+        service:
+            Name of the AWS service eg s3.
+        region_name:
+            Region, defaults to that of the environment.
+        **config:
+            Keyword arguments to botocore Config, overriding CLIENT_CONFIG.
+    
+    Returns:
+        boto3 client.
+    """
+    key = (service, region_name, json.dumps(config, sort_keys=True))
+    try:
+        return clients[key]
+    except KeyError:
+        pass
+    
+    # boto3's default session is not thread safe, so each client is built
+    # from its own session under the lock.
+    with clients_lock:
+        if key not in clients:
+            session = boto3.session.Session()
+            clients[key] = session.client(service,
+                                          region_name=region_name,
+                                          config=Config(**{**CLIENT_CONFIG, **config}))
+        return clients[key]
 
 
 
@@ -83,28 +136,83 @@ def ec2_metadata():
 
 
 
-def rsa_signer(key_id):
-    def rsa_signer(message):
-        with open(f"{key_id}_private_key.pem", "rb") as key_file:
+def _private_key(key_id):
+    """ Returns the private key loaded from {key_id}_private_key.pem. Cached
+        and only reloaded if the file is modified.
+    """
+    path = f"{key_id}_private_key.pem"
+    mtime = os.stat(path).st_mtime_ns
+    cached = private_keys.get(key_id)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as key_file:
             private_key = serialization.load_pem_private_key(
                 key_file.read(),
                 password=None,
                 backend=default_backend()
                 )
-        return private_key.sign(message, padding.PKCS1v15(), hashes.SHA1())
+        cached = private_keys[key_id] = (mtime, private_key)
+    return cached[1]
+
+
+
+def rsa_signer(key_id):
+    def rsa_signer(message):
+        return _private_key(key_id).sign(message, padding.PKCS1v15(), hashes.SHA1())
     return rsa_signer
 
 
 
 def cloudfront_sign_url(url, key_id, **offset):
-    expires_datetime = datetime.now() + timedelta(**(offset or {"days": 1}))
+    expires_datetime = datetime.now(timezone.utc) + timedelta(**(offset or {"days": 1}))
     cloudfront_signer = CloudFrontSigner(key_id, rsa_signer(key_id))
     return cloudfront_signer.generate_presigned_url(url, date_less_than=expires_datetime)
 
 
 
+def cloudfront_sign_urls(urls, key_id, resource=None, **offset):
+    """ Sign many urls with a single signature.
+    
+    A custom policy granting access to resource is signed once and the
+    same signature appended to every url, rather than signing a canned
+    policy per url.
+    
+    Args:
+        urls:
+            Sequence of urls to sign.
+        key_id:
+            CloudFront key pair id.
+        resource:
+            Url, which may contain * wildcards, that the policy grants
+            access to. Must match every url. Defaults to the longest
+            common prefix of urls followed by *. Pass it explicitly if
+            that would be broader than intended.
+        **offset:
+            Keyword arguments to timedelta for the expiry (default 1 day).
+    
+    Returns:
+        List of signed urls.
+    """
+    expires_datetime = datetime.now(timezone.utc) + timedelta(**(offset or {"days": 1}))
+    if resource is None:
+        resource = os.path.commonprefix(list(urls)) + "*"
+    cloudfront_signer = CloudFrontSigner(key_id, rsa_signer(key_id))
+    
+    policy = cloudfront_signer.build_policy(resource, expires_datetime).encode("utf8")
+    params = "Policy={}&Signature={}&Key-Pair-Id={}".format(
+        cloudfront_signer._url_b64encode(policy).decode("utf8"),
+        cloudfront_signer._url_b64encode(cloudfront_signer.rsa_signer(policy)).decode("utf8"),
+        key_id)
+    return [f"{url}{'&' if '?' in url else '?'}{params}" for url in urls]
+
+
+
 def cloudfront_sign_cookies(url, key_id, **offset):
-    expires_datetime = datetime.now() + timedelta(**(offset or {"days": 1}))
+    expires_datetime = datetime.now(timezone.utc) + timedelta(**(offset or {"days": 1}))
+    return _cloudfront_cookies(url, key_id, expires_datetime)
+
+
+
+def _cloudfront_cookies(url, key_id, expires_datetime):
     rsa_sign = rsa_signer(key_id)
     cloudfront_signer = CloudFrontSigner(key_id, rsa_sign)
     
@@ -119,10 +227,49 @@ def cloudfront_sign_cookies(url, key_id, **offset):
 
 
 
+def cloudfront_cached_cookies(url, key_id, lifetime=24*60*60, bucket=60*60):
+    """ As cloudfront_sign_cookies but the signed cookies are shared by all
+        callers within the same bucket of time.
+    
+    The expiry is rounded up to the end of the current bucket plus
+    lifetime, therefore the policy, and so the signature, are identical for
+    every request within a bucket and are only signed once per bucket.
+    The cookies remain valid for between lifetime and lifetime + bucket
+    seconds.
+    
+    Args:
+        url:
+            Url, which may contain * wildcards, that the cookies grant
+            access to.
+        key_id:
+            CloudFront key pair id.
+        lifetime:
+            Minimum seconds for which the cookies are valid.
+        bucket:
+            Seconds for which the same cookies are reused.
+    
+    Returns:
+        Tuple of cookies as json and their expiry as a unix timestamp.
+    """
+    start = int(time.time() // bucket) * bucket
+    key = (url, key_id, start)
+    try:
+        return signed_cookies[key]
+    except KeyError:
+        pass
+    
+    expires = start + bucket + lifetime
+    cookies = _cloudfront_cookies(url, key_id, datetime.fromtimestamp(expires, timezone.utc))
+    for stale in [k for k in list(signed_cookies) if k[2] < start]:
+        signed_cookies.pop(stale, None)
+    signed_cookies[key] = (cookies, expires)
+    return cookies, expires
+
+
+
 def s3_sign_url(bucket, key, **offset):
     expires = int(timedelta(**(offset or {"days": 1})).total_seconds())
-    print(expires)
-    client = boto3.client("s3", config=Config(s3={"use_accelerate_endpoint": True}))
+    client = boto3_client("s3", s3={"use_accelerate_endpoint": True})
     return client.generate_presigned_url(ClientMethod="put_object",
                                          ExpiresIn=expires,
                                          Params={"Bucket": bucket, "Key": key})
@@ -142,7 +289,7 @@ def sendmail(recipients, subject, body):
     if isinstance(recipients, str):
         recipients = recipients.split(",")
     
-    client = boto3.client('ses', region_name=region)
+    client = boto3_client("ses", region_name=region)
 
     try:
         response = client.send_email(
@@ -167,7 +314,7 @@ def sendmail(recipients, subject, body):
 def list_objects(bucket, prefix):
     """ Returns a dict of all objects in bucket that have the specified prefix
     """
-    client = boto3.client("s3")
+    client = boto3_client("s3")
     response = {}
     kwargs = {}
     keys = {}
@@ -183,11 +330,11 @@ def list_objects(bucket, prefix):
 def object_exists(bucket, path):
     """
     """
-    client = boto3.client("s3")
+    client = boto3_client("s3")
     response = {}
     kwargs = {}
     while response.get("IsTruncated", True):
-        response = client.list_objects_v2(Bucket=bucket, Prefix=prefix, **kwargs)
+        response = client.list_objects_v2(Bucket=bucket, Prefix=path, **kwargs)
         for content in response.get("Contents", ()):
             if content["Key"] == path:
                 return True
@@ -204,7 +351,7 @@ def run_task(task, command):
     config = current_app.config
     availability_zone = config.get("AWS_AVAILABILITY_ZONE", "") or (config.get("AWS_REGION", "") + "?")
     
-    ecs = boto3.client("ecs")
+    ecs = boto3_client("ecs")
     #subnet = current_app.config["AWS_SUBNET"]
     
     for tries in (0, 1):
@@ -248,8 +395,8 @@ def run_task(task, command):
                 next_best_subnet = any_subnet = ""
                 response = None
                 next_token = {}
+                ec2 = boto3_client("ec2")
                 while response is None or "nextToken" in response:
-                    ec2 = boto3.client("ec2")
                     response = ec2.describe_subnets(**next_token)
                     next_token = {"nextToken": response.get("nextToken", "")}
                     if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
@@ -15,6 +15,11 @@ import psycopg2
 from psycopg2.extensions import register_adapter, ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
 from psycopg2.extras import Json
 
+try:
+    from bsclient import bs_client
+except ImportError: # Imported from within the aireal package rather than run as a script
+    from .bsclient import bs_client
+
 
 register_adapter(dict, Json)
 trim_lane_regex = re.compile("_L[0-9]{3}$")
@@ -31,18 +36,7 @@ def iso8601_to_utc(dt_string):
 
 
 def bsget(url, token, params={}):
-    response = requests.get(url,
-                            params=params, 
-                            headers={"x-access-token": token},
-                            stream=True)
-    response.raise_for_status()
-    return response.json()
-    #except requests.exceptions.RequestException as e:
-        #print(e)
-        #pdb.set_trace() # need to add proper handling
-    #except requests.exceptions.JSONDecodeError as e:
-        #print(e)
-        #pass
+    return bs_client.json(url, token, params=params)
 
 
 
@@ -83,13 +77,8 @@ def bsget_appsession(bsserver, token, bsid):
             if prop["ItemsDisplayedCount"] == prop["ItemsTotalCount"]:
                 items = prop["DatasetItems"]
             else:
-                items = []
-                total = prop["ItemsTotalCount"]
-                while len(items) < total:
-                    response = bsget(f"{bsserver}/v2/appsessions/{bsid}/properties/Output.Datasets/items",
-                                      token, params={"offset": len(items), "SortBy": "DateCreated", "SortDir": "Desc"})
-                    for item in response["Items"]:
-                        items.append(item["Dataset"])
+                items = [item["Dataset"] for item in bs_client.items(f"{bsserver}/v2/appsessions/{bsid}/properties/Output.Datasets/items",
+                                                                      token, params={"SortBy": "DateCreated", "SortDir": "Desc"})]
             
             for item in items:
                 pdb.set_trace()
@@ -128,20 +117,16 @@ def bsrefresh(db_uri):
         
         for account_id, server_id, server, token, run_lastmodified, appsession_lastmodified in rows:
             modified_runs = []
-            offset = 0
-            total_count = 1
-            while offset < total_count:
-                response = bsget_runs(server, token, offset=offset)
-                paging = response["Paging"]
-                total_count = paging["TotalCount"]
-                offset = paging["Offset"] + paging["DisplayedCount"]
-                for item in response["Items"]:
-                    item = item["Run"]
-                    datetime_modified = iso8601_to_utc(item["DateModified"])
-                    if run_lastmodified is not None and datetime_modified <= run_lastmodified:
-                        offset = total_count
-                        break
-                    modified_runs.append(item)
+            runs = bs_client.items(f"{server}/v2/search", token, limit=10, params={"scope": "runs",
+                                                                                 "query": "(experimentname:*)",
+                                                                                 "SortBy": "DateModified",
+                                                                                 "SortDir": "Desc"})
+            for item in runs:
+                item = item["Run"]
+                datetime_modified = iso8601_to_utc(item["DateModified"])
+                if run_lastmodified is not None and datetime_modified <= run_lastmodified:
+                    break
+                modified_runs.append(item)
             
             modified_runs.reverse()
             for run_json in modified_runs:
@@ -154,19 +139,14 @@ def bsrefresh(db_uri):
                     #raise
                 
                 modified_appsessions = []
-                offset = 0
-                total_count = 1
-                while offset < total_count:
-                    response = bsget_appsessions(server, token, run_json["Id"], offset=offset)
-                    paging = response["Paging"]
-                    total_count = paging["TotalCount"]
-                    offset = paging["Offset"] + paging["DisplayedCount"]
-                    for item in response["Items"]:
-                        datetime_modified = iso8601_to_utc(item["DateModified"])
-                        if appsession_lastmodified is not None and datetime_modified <= appsession_lastmodified:
-                            offset = total_count
-                            break
-                        modified_appsessions.append(item["Id"])
+                appsessions = bs_client.items(f"{server}/v2/appsessions", token, limit=10, params={"input.runs": run_json["Id"],
+                                                                                                 "SortBy": "DateModified",
+                                                                                                 "SortDir": "Desc"})
+                for item in appsessions:
+                    datetime_modified = iso8601_to_utc(item["DateModified"])
+                    if appsession_lastmodified is not None and datetime_modified <= appsession_lastmodified:
+                        break
+                    modified_appsessions.append(item["Id"])
                 
                 modified_appsessions = [bsget_appsession(server, token, bsid) for bsid in modified_appsessions]
                 if not modified_appsessions:
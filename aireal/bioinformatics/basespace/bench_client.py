@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import json
+import threading
+import pdb
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    from bsclient import BaseSpaceClient
+except ImportError: # Imported from within the aireal package rather than run as a script
+    from .bsclient import BaseSpaceClient
+
+
+PAGE_LIMIT = 10 # Page size used by the web application's views
+
+
+
+class StandIn(ThreadingHTTPServer):
+    """ Local http server standing in for the BaseSpace api that counts
+        the requests and connections it receives. The first throttle
+        requests are refused with 429 and a Retry-After header.
+    """
+    daemon_threads = True
+
+    def __init__(self, n_runs, n_appsessions, n_datasets, throttle=0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.n_runs = n_runs
+        self.n_appsessions = n_appsessions
+        self.n_datasets = n_datasets
+        self.throttle = throttle
+        self.requests = 0
+        self.connections = 0
+        self.cookies = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def reset(self):
+        with self._lock:
+            counts = (self.requests, self.connections)
+            self.requests = self.connections = 0
+        return counts
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server._lock:
+            server.requests += 1
+            throttled = server.throttle > 0
+            if throttled:
+                server.throttle -= 1
+            if "Cookie" in self.headers:
+                server.cookies += 1
+
+        if throttled:
+            return self.reply(429, {}, {"Retry-After": "0"})
+
+        url = urlsplit(self.path)
+        query = {key: val[0] for key, val in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        if parts == ["v2", "search"]:
+            body = self.page([{"Run": {"Id": str(i), "ExperimentName": f"Run{i}"}} for i in range(server.n_runs)], query)
+        elif parts == ["v2", "appsessions"]:
+            body = self.page([{"Id": str(i)} for i in range(server.n_appsessions)], query)
+        elif len(parts) == 3 and parts[:2] == ["v2", "appsessions"]:
+            # Like BaseSpace only the first page of datasets is embedded.
+            datasets = [{"Name": f"Sample{i}_L001"} for i in range(min(server.n_datasets, PAGE_LIMIT))]
+            body = {"Id": parts[2],
+                    "Properties": {"Items": [{"Name": "Output.Datasets",
+                                              "DatasetItems": datasets,
+                                              "ItemsDisplayedCount": len(datasets),
+                                              "ItemsTotalCount": server.n_datasets}]}}
+        elif parts[:2] == ["v2", "appsessions"] and parts[3:] == ["properties", "Output.Datasets", "items"]:
+            body = self.page([{"Dataset": {"Name": f"Sample{i}_L001"}} for i in range(server.n_datasets)], query)
+        else:
+            return self.reply(404, {})
+        self.reply(200, body, {"Set-Cookie": "session=stand-in; Path=/"})
+
+    def page(self, items, query):
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", PAGE_LIMIT))
+        page = items[offset:offset + limit]
+        return {"Items": page,
+                "Paging": {"DisplayedCount": len(page), "Offset": offset, "TotalCount": len(items)}}
+
+    def reply(self, status, body, headers={}):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+def page_views(client, server, token):
+    """ Dict of the name of each BaseSpace page of the web application to
+        a function making the same api calls as its view, see views.py.
+    """
+    url = server.url
+    def bsruns():
+        client.json(f"{url}/v2/search", token, params={"scope": "runs", "offset": 0, "limit": PAGE_LIMIT})
+
+    def bsappsessions():
+        client.json(f"{url}/v2/appsessions", token, params={"input.runs": "0", "offset": 0, "limit": PAGE_LIMIT})
+
+    def bsdatasets():
+        appsession = client.json(f"{url}/v2/appsessions/0", token)
+        for prop in appsession["Properties"]["Items"]:
+            if prop["Name"] == "Output.Datasets" and prop["ItemsDisplayedCount"] != prop["ItemsTotalCount"]:
+                list(client.items(f"{url}/v2/appsessions/0/properties/Output.Datasets/items", token))
+
+    return {"bsruns": bsruns, "bsappsessions": bsappsessions, "bsdatasets": bsdatasets}
+
+
+
+def main():
+    """ Count the upstream BaseSpace api calls and connections made by each
+        BaseSpace page of the web application, by making the same calls as
+        each view with a BaseSpaceClient against a local stand-in server.
+        Exits non-zero if any view makes more calls than expected, a
+        connection is not reused or a cookie is sent back.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--runs", help="Number of runs.", type=int, default=25)
+    parser.add_argument("-a", "--appsessions", help="Number of appsessions per run.", type=int, default=3)
+    parser.add_argument("-d", "--datasets", help="Number of datasets per appsession.", type=int, default=96)
+    parser.add_argument("-t", "--throttle", help="Number of requests refused with 429 before each view.", type=int, default=0)
+    parser.add_argument("-v", "--views", help="Number of times each view is requested.", type=int, default=3)
+    args = parser.parse_args()
+
+    server = StandIn(args.runs, args.appsessions, args.datasets)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = BaseSpaceClient(rate=1000, burst=1000, backoff=0)
+
+    # Default page size of the datasets collection is used by bs_items.
+    dataset_pages = -(-max(args.datasets, 1) // PAGE_LIMIT)
+    expected = {"bsruns": 1,
+                "bsappsessions": 1,
+                "bsdatasets": 1 + (dataset_pages if args.datasets > PAGE_LIMIT else 0)}
+
+    errors = []
+    for name, view in page_views(client, server, "stand-in-token").items():
+        for i in range(args.views):
+            server.throttle = args.throttle
+            calls = client.calls
+            view()
+            requests, connections = server.reset()
+            calls = client.calls - calls
+            print(f"{name}: {calls} calls, {requests} upstream requests, {connections} new connections", file=sys.stderr)
+            if calls != expected[name]:
+                errors.append(f"{name} made {calls} calls, expected {expected[name]}")
+            if requests != calls + args.throttle:
+                errors.append(f"{name} made {requests} upstream requests for {calls} calls")
+            if connections > 1:
+                errors.append(f"{name} opened {connections} connections")
+    if server.cookies:
+        errors.append(f"Cookies were sent with {server.cookies} requests")
+    server.shutdown()
+
+    if errors:
+        sys.exit("\n".join(errors))
+    print("OK", file=sys.stderr)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import hashlib
+import resource
+import threading
+import time
+import tracemalloc
+import pdb
+
+import boto3
+from botocore.exceptions import ClientError
+
+try:
+    from bsimport import MiB, RANGE_CONCURRENCY, part_size_for, stream_upload
+except ImportError: # Imported from within the aireal package rather than run as a script
+    from .bsimport import MiB, RANGE_CONCURRENCY, part_size_for, stream_upload
+
+try:
+    from moto import mock_aws
+except ImportError:
+    try:
+        from moto import mock_s3 as mock_aws
+    except ImportError:
+        mock_aws = None
+
+
+
+BLOCK = bytes(range(256)) * 4096 # 1 MiB pattern repeated to form the content
+
+
+
+class PatternStream(object):
+    """ Binary file like object of bytes offset to end of content that is
+        BLOCK repeated, generated as it is read so that the source content
+        takes no memory.
+    """
+    def __init__(self, offset, end):
+        self.position = offset
+        self.end = end
+
+    def readinto(self, b):
+        view = memoryview(b)
+        n = 0
+        while n < len(view) and self.position < self.end:
+            start = self.position % len(BLOCK)
+            chunk = min(len(view) - n, len(BLOCK) - start, self.end - self.position)
+            view[n:n + chunk] = BLOCK[start:start + chunk]
+            n += chunk
+            self.position += chunk
+        return n
+
+    def close(self):
+        pass
+
+
+
+def pattern_opener(size):
+    """ Returns an open_content function, see bsimport.content_opener,
+        for size bytes of pattern.
+    """
+    def open_content(offset=0, end=None):
+        return PatternStream(offset, size if end is None else end)
+    return open_content
+
+
+
+def pattern_md5(size):
+    md5 = hashlib.md5()
+    remaining = size
+    while remaining:
+        chunk = min(remaining, len(BLOCK))
+        md5.update(BLOCK[:chunk])
+        remaining -= chunk
+    return md5.hexdigest()
+
+
+
+class Interrupted(BaseException):
+    """ The import being stopped part way through. Not an Exception, as
+        that would be aborted if permanent or retried if transient.
+    """
+
+
+
+class RecordingClient(object):
+    """ Wrapper around a boto3 s3 client that records the number of every
+        part uploaded and, if fail_part is given, fails the upload of that
+        part with error, by default Interrupted to simulate an interrupted
+        import.
+    """
+    def __init__(self, s3_client, fail_part=None, error=None):
+        self.s3_client = s3_client
+        self.fail_part = fail_part
+        self.error = error
+        self.uploaded = []
+        self._lock = threading.Lock()
+
+    def upload_part(self, **kwargs):
+        if kwargs["PartNumber"] == self.fail_part:
+            raise self.error or Interrupted(f"Interrupted at part {self.fail_part}")
+        response = self.s3_client.upload_part(**kwargs)
+        with self._lock:
+            self.uploaded.append(kwargs["PartNumber"])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+
+
+def bench(s3_client, bucket, size, fail_part, concurrency):
+    """ Upload size bytes uninterrupted and report throughput and peak
+        memory, then upload them again interrupting the upload at
+        fail_part and check that resuming only sends the missing parts.
+        Finally fail an upload at fail_part with a permanent error and check
+        that it is aborted. Returns a list of errors.
+    """
+    errors = []
+    open_content = pattern_opener(size)
+    part_size = part_size_for(size)
+    n_parts = -(-size // part_size)
+    expected = pattern_md5(size)
+    print(f"{size // MiB} MiB in {n_parts} parts of {part_size // MiB} MiB, {concurrency} at once", file=sys.stderr)
+
+    tracemalloc.start()
+    start = time.monotonic()
+    stream_upload(s3_client, open_content, bucket, "bench/clean", size, concurrency)
+    elapsed = time.monotonic() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"Uninterrupted: {size / MiB / elapsed:.1f} MiB/s, "
+          f"peak python allocations {peak / MiB:.1f} MiB (bound {concurrency * part_size / MiB:.0f} MiB of buffers), "
+          f"max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB", file=sys.stderr)
+
+    first = RecordingClient(s3_client, fail_part=fail_part)
+    try:
+        stream_upload(first, open_content, bucket, "bench/resumed", size, concurrency)
+    except Interrupted as e:
+        print(f"{e}, parts uploaded {sorted(first.uploaded)}", file=sys.stderr)
+    else:
+        errors.append("Upload was not interrupted")
+
+    second = RecordingClient(s3_client)
+    stream_upload(second, open_content, bucket, "bench/resumed", size, concurrency)
+    print(f"Resumed, parts re-sent {sorted(second.uploaded)}", file=sys.stderr)
+
+    if set(first.uploaded) & set(second.uploaded):
+        errors.append(f"Parts {sorted(set(first.uploaded) & set(second.uploaded))} were sent twice")
+    if set(first.uploaded) | set(second.uploaded) != set(range(1, n_parts + 1)):
+        errors.append("Parts are missing")
+    for key in ("bench/clean", "bench/resumed"):
+        md5 = hashlib.md5()
+        for chunk in s3_client.get_object(Bucket=bucket, Key=key)["Body"].iter_chunks(MiB):
+            md5.update(chunk)
+        if md5.hexdigest() != expected:
+            errors.append(f"Content of {key} does not match")
+
+    forbidden = ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"},
+                             "ResponseMetadata": {"HTTPStatusCode": 403}}, "UploadPart")
+    denied = RecordingClient(s3_client, fail_part=fail_part, error=forbidden)
+    try:
+        stream_upload(denied, open_content, bucket, "bench/denied", size, concurrency)
+    except ClientError as e:
+        print(f"{e}, parts uploaded {sorted(denied.uploaded)}", file=sys.stderr)
+    else:
+        errors.append("Upload was not denied")
+    if s3_client.list_multipart_uploads(Bucket=bucket, Prefix="bench/denied").get("Uploads"):
+        errors.append("Denied upload was not aborted")
+    return errors
+
+
+
+def main():
+    """ Benchmark bsimport.stream_upload and check that an interrupted
+        upload resumes by sending only the missing parts while one that
+        fails permanently is aborted. Runs against an in memory S3 provided
+        by moto by default, which holds the uploaded parts in this process
+        and so inflates the memory figures, or against a real S3 compatible
+        endpoint such as MinIO if given.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--size", help="Size of the test content in MiB.", type=int, default=100)
+    parser.add_argument("-f", "--fail-part", help="Part number at which the first upload is interrupted.", type=int, default=4)
+    parser.add_argument("-c", "--concurrency", help="Maximum number of parts transferred simultaneously.", type=int, default=RANGE_CONCURRENCY)
+    parser.add_argument("-e", "--endpoint-url", help="S3 compatible endpoint, eg a local MinIO server, rather than moto.", default=None)
+    parser.add_argument("-b", "--bucket", help="Bucket to upload to, created if needed.", default="bsimport-bench")
+    args = parser.parse_args()
+
+    size = args.size * MiB
+    if args.endpoint_url is not None:
+        s3_client = boto3.client("s3", endpoint_url=args.endpoint_url)
+        try:
+            s3_client.create_bucket(Bucket=args.bucket)
+        except (s3_client.exceptions.BucketAlreadyOwnedByYou, s3_client.exceptions.BucketAlreadyExists):
+            pass
+        errors = bench(s3_client, args.bucket, size, args.fail_part, args.concurrency)
+
+    elif mock_aws is None:
+        sys.exit("moto is not installed, install it or give the --endpoint-url of an S3 compatible server")
+
+    else:
+        with mock_aws():
+            s3_client = boto3.client("s3", region_name="us-east-1")
+            s3_client.create_bucket(Bucket=args.bucket)
+            errors = bench(s3_client, args.bucket, size, args.fail_part, args.concurrency)
+
+    if errors:
+        sys.exit("\n".join(errors))
+    print("OK", file=sys.stderr)
+
+
+
+if __name__ == "__main__":
+    main()
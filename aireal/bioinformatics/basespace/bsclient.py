@@ -0,0 +1,147 @@
+import time
+import threading
+import pdb
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+__all__ = ["BaseSpaceClient",
+           "TokenBucket",
+           "bs_client"]
+
+
+
+class TokenBucket(object):
+    """ Thread safe token bucket that limits the combined rate of everything
+        that consumes from it to rate per second, eg bytes or requests.
+        Consumers may overdraw the bucket and then sleep until the debt is
+        repaid, so a single large request is never refused.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+
+class BaseSpaceClient(object):
+    """ Thread safe BaseSpace api client.
+
+    Every request goes through a single keep-alive requests Session so that
+    connections, and their TLS handshakes, are reused. Only the Session's
+    connection pool is shared, which urllib3 makes thread safe. The rest of
+    the Session is not and so is never modified once created, headers and
+    the token are passed with each request and cookies set by responses
+    are refused rather than stored and sent with other accounts' requests.
+
+    Requests time out rather than hang and connection failures, 429 and 5xx
+    responses are retried with exponential backoff, waiting for as long as
+    any Retry-After header asks. Requests are limited to rate per second
+    across every thread sharing the client, so that one client may serve
+    every account.
+
+    Shared by the web application and the bsimport task, which copies this
+    file into its image, therefore it must only depend on requests and
+    run on Python 3.6.
+
+    Args:
+        rate:
+            Maximum requests per second.
+        burst:
+            Requests that may be made at once before rate applies.
+        retries:
+            Maximum retries of a single request.
+        backoff:
+            Backoff factor in seconds, the nth retry waits backoff * 2^n.
+        timeout:
+            Tuple of connect and read timeouts in seconds.
+        pool_size:
+            Connections kept open per host, at least the number of threads
+            making requests simultaneously.
+    """
+    def __init__(self, rate=10, burst=20, retries=5, backoff=0.5, timeout=(10, 60), pool_size=10):
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, burst)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+        retry = Retry(total=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    def get(self, url, token, params=None, headers=None, stream=False):
+        """ GET url and return the response. Raises requests HTTPError if
+            the final response is an error.
+        """
+        self.limiter.consume()
+        with self._lock:
+            self.calls += 1
+        response = self.session.get(url,
+                                    params=params,
+                                    headers=dict(headers or {}, **{"x-access-token": token}),
+                                    stream=stream,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+    def json(self, url, token, params=None):
+        """ GET url and return the decoded json.
+        """
+        return self.get(url, token, params=params).json()
+
+
+    def items(self, url, token, params=None, limit=None):
+        """ Generator of every item of a paged BaseSpace collection,
+            requesting each page as the previous one is consumed.
+
+        Args:
+            url:
+                Url of the collection.
+            token:
+                BaseSpace access token.
+            params:
+                Query parameters other than offset.
+            limit:
+                Items per page, the server default if None.
+        """
+        params = dict(params or {})
+        if limit is not None:
+            params["limit"] = limit
+        offset = params.pop("offset", 0)
+        while True:
+            response = self.json(url, token, params=dict(params, offset=offset))
+            yield from response["Items"]
+            paging = response["Paging"]
+            displayed = paging["DisplayedCount"]
+            offset = paging["Offset"] + displayed
+            if not displayed or offset >= paging["TotalCount"]:
+                break
+
+
+
+# Shared by every account and request of a process so that they share its
+# connection pool and rate limit.
+bs_client = BaseSpaceClient()
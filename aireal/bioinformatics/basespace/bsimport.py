@@ -5,77 +5,417 @@ import sys
 import argparse
 import re
 import io
+import json
+import queue
+import time
+import threading
 import pdb
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
 import requests
+import urllib3
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+try:
+    from bsclient import BaseSpaceClient, TokenBucket
+except ImportError: # Imported from within the aireal package rather than run as a script
+    from .bsclient import BaseSpaceClient, TokenBucket
 
 
 trim_lane_regex = re.compile("_L[0-9]{3}$")
 
+MiB = 1024 * 1024
+MIN_PART_SIZE = 16 * MiB
+MAX_PARTS = 10000
+RANGE_CONCURRENCY = 4
+RANGE_RETRIES = 5
+FILE_CONCURRENCY = 4
+MAX_COPY_SIZE = 5 * 1024 * MiB # Largest CopyObject, above which UploadPartCopy is used
+COPY_PART_SIZE = 512 * MiB
+
+
+
+def content_opener(client, url, token, limiter=None):
+    """ Returns a function that opens the content at url from byte offset
+        up to, but not including, byte end, or the end of the content if
+        None, and returns it as a binary file like object. Reads are
+        throttled by limiter, a TokenBucket, if given.
+    """
+    def open_content(offset=0, end=None):
+        if end is not None:
+            headers = {"Range": f"bytes={offset}-{end - 1}"}
+        else:
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+        response = client.get(url, token, headers=headers, stream=True)
+        stream = response.raw
+        # Ranges are of the stored bytes therefore never decode.
+        stream.decode_content = False
+        if offset and response.status_code != 206:
+            # Range not honoured, discard up to the offset instead.
+            skip = bytearray(min(offset, 8 * MiB))
+            remaining = offset
+            while remaining:
+                n = read_into(stream, memoryview(skip)[:min(remaining, len(skip))])
+                if not n:
+                    raise RuntimeError(f"{url} ended before offset {offset}")
+                remaining -= n
+        return stream if limiter is None else ThrottledStream(stream, limiter)
+    return open_content
+
+
+
+class ThrottledStream(object):
+    """ Binary file like wrapper that charges every byte read to a
+        TokenBucket.
+    """
+    def __init__(self, stream, limiter):
+        self.stream = stream
+        self.limiter = limiter
+
+    def readinto(self, b):
+        n = self.stream.readinto(b)
+        if n:
+            self.limiter.consume(n)
+        return n
 
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.limiter.consume(len(data))
+        return data
 
-def bs_get(url, token, params={}):
-    response = requests.get(url, params=params, headers={"x-access-token": token}, stream=True)
-    response.raise_for_status()
-    return response
+    def close(self):
+        self.stream.close()
 
 
 
-def stream_upload(s3_client, download, bucket, key):
+def read_into(stream, view):
+    """ Fill view from stream. Returns the number of bytes read which is
+        only less than len(view) at the end of the stream.
     """
+    n = 0
+    while n < len(view):
+        read = stream.readinto(view[n:])
+        if not read:
+            break
+        n += read
+    return n
+
+
+
+def part_size_for(size):
+    """ Returns the smallest whole number of MiB, but at least
+        MIN_PART_SIZE, that allows size bytes to be uploaded in at most
+        MAX_PARTS parts.
     """
+    needed = -(-size // MAX_PARTS)
+    return max(MIN_PART_SIZE, -(-needed // MiB) * MiB)
+
+
+
+def retryable(e):
+    """ Returns True if a failed range transfer may succeed if retried.
+        Error responses are not, BaseSpaceClient has already retried those
+        that are transient.
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return False
+    return isinstance(e, (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError))
+
+
+
+def resumable(e):
+    """ Returns True if an upload that failed with e should be kept for the
+        next attempt to resume, ie the failure was a connection error or
+        other transient fault rather than, eg, a revoked token or missing
+        permissions that would fail again.
+    """
+    if isinstance(e, ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status >= 500 or e.response.get("Error", {}).get("Code") in ("SlowDown", "RequestTimeout")
+    return retryable(e) or isinstance(e, BotoConnectionError)
+
+
+
+def transfer_ranges(open_content, size, part_size, write, concurrency=RANGE_CONCURRENCY, skip=()):
+    """ Download content in byte ranges of part_size, up to concurrency
+        ranges at once, each over its own connection.
     
-    # download is a Response object from the requests package
-    chunked_download = download.iter_content(chunk_size=8*1024*1024) # 8MB
+    Each range is read into a buffer owned by its worker thread and then
+    passed to write, therefore memory use is concurrency * part_size
+    whatever the size of the content. A range that fails, including its
+    write, is retried with exponential backoff up to RANGE_RETRIES times
+    before the whole transfer is abandoned.
     
-    response = s3_client.create_multipart_upload(Bucket=bucket, Key=key)
-    if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-        raise RuntimeError("")
+    Args:
+        open_content:
+            Function taking a start and end byte offset and returning a
+            binary file like object of that range, see content_opener.
+        size:
+            Size of the content in bytes.
+        part_size:
+            Bytes per range.
+        write:
+            Function called with (part_number, offset, buf, n) where the
+            range starting at offset is the first n bytes of bytearray buf.
+            Part numbers start from 1. Must be thread safe.
+        concurrency:
+            Maximum number of ranges transferred simultaneously.
+        skip:
+            Part numbers that are already present and are not transferred.
     
-    upload_id = response['UploadId']
-    file_obj = io.BytesIO()
-    parts = []
+    Returns:
+        Dict of part number to the return value of write.
+    """
+    local = threading.local()
     
-    try:
+    def transfer(part_number):
+        offset = (part_number - 1) * part_size
+        n = min(part_size, size - offset)
+        buf = getattr(local, "buf", None)
+        if buf is None:
+            buf = local.buf = bytearray(part_size)
+        
+        attempt = 0
         while True:
-            file_obj.seek(0)
-            file_obj.truncate()
-            
-            n_bytes = 0
-            while n_bytes < 512 * 1024 * 1024: # 0.5GB
+            try:
+                stream = open_content(offset, offset + n)
                 try:
-                    n_bytes += file_obj.write(next(chunked_download))
-                except StopIteration:
-                    break
-
-            if file_obj.tell() == 0:
-                break
-            content_length = file_obj.tell()
-            file_obj.seek(0)
-            response = s3_client.upload_part(Body=file_obj,
-                                             Bucket=bucket, 
-                                             Key=key,
-                                             ContentLength=content_length,
-                                             PartNumber=len(parts) + 1,
-                                             UploadId=upload_id)
-            parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
-            
-        response = s3_client.complete_multipart_upload(Bucket=bucket,
-                                                       Key=key,
-                                                       MultipartUpload={'Parts': parts},
-                                                       UploadId=upload_id)
-    except Exception:
-        response = s3_client.abort_multipart_upload(Bucket=bucket,
-                                                    Key=key,
-                                                    UploadId=upload_id)
+                    received = read_into(stream, memoryview(buf)[:n])
+                finally:
+                    stream.close()
+                if received != n:
+                    raise IOError(f"Expected {n} bytes from offset {offset} but received {received}")
+                return write(part_number, offset, buf, n)
+            except Exception as e:
+                attempt += 1
+                if attempt > RANGE_RETRIES or not retryable(e):
+                    raise
+                print(f"Retrying range {part_number} after {e}", file=sys.stderr)
+                time.sleep(min(2 ** attempt, 60))
+    
+    n_parts = -(-size // part_size)
+    results = {}
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(transfer, part_number): part_number
+                   for part_number in range(1, n_parts + 1) if part_number not in skip}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+
+def resumable_upload(s3_client, bucket, key, size, part_size):
+    """ Find an unfinished multipart upload of key left by a previous
+        attempt with the same part size and return its id along with the
+        ETags of the parts that were completely uploaded. Any other
+        unfinished uploads of key are aborted. A new upload is created if
+        there is none to resume.
+    
+    Returns:
+        Tuple of upload id and dict of part number to ETag.
+    """
+    uploads = []
+    for page in s3_client.get_paginator("list_multipart_uploads").paginate(Bucket=bucket, Prefix=key):
+        uploads.extend(upload for upload in page.get("Uploads", ()) if upload["Key"] == key)
+    uploads.sort(key=lambda upload: upload["Initiated"], reverse=True)
+    
+    n_parts = -(-size // part_size)
+    upload_id = None
+    etags = {}
+    for upload in uploads:
+        if upload_id is None:
+            uploaded = {}
+            for page in s3_client.get_paginator("list_parts").paginate(Bucket=bucket, Key=key, UploadId=upload["UploadId"]):
+                for part in page.get("Parts", ()):
+                    uploaded[part["PartNumber"]] = part
+            if all(part_number <= n_parts and part["Size"] == min(part_size, size - (part_number - 1) * part_size)
+                   for part_number, part in uploaded.items()):
+                upload_id = upload["UploadId"]
+                etags = {part_number: part["ETag"] for part_number, part in uploaded.items()}
+                continue
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload["UploadId"])
+    
+    if upload_id is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    return upload_id, etags
+
+
+
+def stream_upload(s3_client, open_content, bucket, key, size, concurrency=RANGE_CONCURRENCY):
+    """ Copy content of known size to s3 as a multipart upload.
+    
+    Each part is a byte range of the content downloaded, over its own
+    connection, straight into the matching part of the upload with up to
+    concurrency parts in flight, see transfer_ranges. The part size is
+    chosen from size so that the file fits within the S3 limit on the
+    number of parts.
+    
+    An unfinished upload is deliberately not aborted if it fails with a
+    resumable error, or the process is stopped. The next attempt resumes
+    it, downloading only the parts that are missing, provided that they
+    were uploaded with the same part size. Any other error, eg a 403 from
+    BaseSpace or S3, aborts the upload so that its parts are not left
+    behind. A bucket lifecycle rule should still be used to expire
+    abandoned uploads.
+    
+    Args:
+        s3_client:
+            boto3 s3 client.
+        open_content:
+            Function taking a start and end byte offset and returning a
+            binary file like object of that range, see content_opener.
+        bucket:
+            Destination bucket.
+        key:
+            Destination key.
+        size:
+            Size of the content in bytes.
+        concurrency:
+            Maximum number of parts transferred simultaneously.
+    
+    Returns:
+        None.
+    """
+    if size == 0:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=b"")
+        return
+    
+    part_size = part_size_for(size)
+    upload_id, etags = resumable_upload(s3_client, bucket, key, size, part_size)
+    
+    def upload_part(part_number, offset, buf, n):
+        response = s3_client.upload_part(Body=buf if n == part_size else buf[:n],
+                                         Bucket=bucket,
+                                         Key=key,
+                                         ContentLength=n,
+                                         PartNumber=part_number,
+                                         UploadId=upload_id)
+        return response["ETag"]
+    
+    try:
+        etags.update(transfer_ranges(open_content, size, part_size, upload_part, concurrency, skip=etags))
+        s3_client.complete_multipart_upload(Bucket=bucket,
+                                            Key=key,
+                                            MultipartUpload={"Parts": [{"ETag": etag, "PartNumber": part_number} for part_number, etag in sorted(etags.items())]},
+                                            UploadId=upload_id)
+    except Exception as e:
+        if not resumable(e):
+            try:
+                s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            except ClientError as abort_error:
+                print(f"Unable to abort upload of {key}: {abort_error}", file=sys.stderr)
         raise
 
 
 
+def ranged_download(open_content, path, size, concurrency=RANGE_CONCURRENCY):
+    """ Download content of known size to path, transferring byte ranges
+        concurrently and writing each at its offset in the file. The
+        content is written to a temporary file which only replaces path
+        once complete, so a partial download is never mistaken for a
+        finished one.
+    """
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as f_out:
+        fd = f_out.fileno()
+        os.ftruncate(fd, size)
+        
+        def pwrite(part_number, offset, buf, n):
+            view = memoryview(buf)[:n]
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        
+        if size:
+            transfer_ranges(open_content, size, part_size_for(size), pwrite, concurrency)
+    os.replace(tmp_path, path)
+
+
+
+def split_s3_url(url):
+    """ Returns the bucket and key, or prefix, of an s3://bucket/key url.
+    """
+    bucket, _sep, key = url[5:].partition("/")
+    return bucket, key
+
+
+
+class ContentIndex(object):
+    """ Index of where each imported BaseSpace file already exists in s3,
+        so that a re-import, eg of the same sample into another project,
+        is copied within s3 rather than downloaded from BaseSpace again.
+    
+    Stored as one small json object per BaseSpace file id under url, which
+    records the size and BaseSpace ETag of the file along with the bucket,
+    key and s3 ETag of its copy. An entry is only used if all of these
+    still match, so files that have since changed, or copies that have
+    been overwritten or deleted, are downloaded as normal. The index is
+    only an optimisation and any failure to read it is ignored.
+    """
+    def __init__(self, s3_client, url):
+        self.s3_client = s3_client
+        self.bucket, prefix = split_s3_url(url)
+        self.prefix = prefix.rstrip("/")
+
+    def _key(self, item):
+        return f"{self.prefix}/{item['Id']}.json" if self.prefix else f"{item['Id']}.json"
+
+    def lookup(self, item):
+        """ Returns the (bucket, key) of a verified copy of item or None.
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(item))
+            entry = json.loads(response["Body"].read())
+            if entry["Size"] != item["Size"] or entry["BaseSpaceETag"] != item.get("ETag"):
+                return None
+            response = self.s3_client.head_object(Bucket=entry["Bucket"], Key=entry["Key"])
+        except (ClientError, ValueError, KeyError):
+            return None
+        if response["ContentLength"] != item["Size"] or response["ETag"] != entry["ETag"]:
+            return None
+        return entry["Bucket"], entry["Key"]
+
+    def record(self, item, bucket, key):
+        """ Record that bucket/key holds a copy of item.
+        """
+        response = self.s3_client.head_object(Bucket=bucket, Key=key)
+        entry = {"Id": item["Id"],
+                 "Size": item["Size"],
+                 "BaseSpaceETag": item.get("ETag"),
+                 "Bucket": bucket,
+                 "Key": key,
+                 "ETag": response["ETag"]}
+        self.s3_client.put_object(Bucket=self.bucket,
+                                  Key=self._key(item),
+                                  Body=json.dumps(entry).encode(),
+                                  ContentType="application/json")
+
+
+
+def s3_copy(s3_client, source_bucket, source_key, bucket, key, concurrency=RANGE_CONCURRENCY):
+    """ Copy an object within s3 without downloading it, with a single
+        CopyObject if possible or concurrent UploadPartCopy requests for
+        objects larger than CopyObject allows.
+    """
+    config = TransferConfig(multipart_threshold=MAX_COPY_SIZE,
+                            multipart_chunksize=COPY_PART_SIZE,
+                            max_concurrency=concurrency)
+    s3_client.copy({"Bucket": source_bucket, "Key": source_key}, bucket, key, Config=config)
+
+
+
 def s3_exists(s3_client, bucket, key, size=None):
     try:
         response = s3_client.head_object(Bucket=bucket, Key=key)
@@ -92,14 +432,137 @@ def file_exists(path, size=None):
 
 
 
-def post(url, data={}):
-    print(data, file=sys.stderr)
-    requests.post(url, data=data)
+class Callbacks(object):
+    """ Posts progress callbacks from a single background thread in the
+        order in which they were made, therefore the callbacks of each
+        sample arrive in order and workers never wait on the server. A
+        callback that cannot be delivered is reported and dropped.
+    """
+    def __init__(self, url=None):
+        self.url = url
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, data):
+        self._queue.put(data)
 
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            print(data, file=sys.stderr)
+            if self.url:
+                try:
+                    requests.post(self.url, data=data, timeout=60)
+                except requests.exceptions.RequestException as e:
+                    print(f"Callback failed {e}", file=sys.stderr)
 
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
 
-def dont_post(url, data={}):
-    print(data, file=sys.stderr)
+
+
+class SampleImport(object):
+    """ Tracks the files of a single sample, which are imported
+        concurrently, and reports the sample once every file has finished.
+        A failed file does not stop the others, the sample is reported as
+        complete with its destinations if every file succeeded, otherwise
+        as failed with the reason for each failed file.
+    """
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self.destinations = []
+        self.errors = []
+        self._pending = 1 # Released by listed()
+        self._lock = threading.Lock()
+
+    def add(self, filename, future):
+        with self._lock:
+            self._pending += 1
+        future.add_done_callback(partial(self._done, filename))
+
+    def fail(self, details):
+        with self._lock:
+            self.errors.append(details)
+
+    def listed(self):
+        """ Call once every file of the sample has been added.
+        """
+        self._release()
+
+    def _done(self, filename, future):
+        try:
+            destination = future.result()
+        except requests.exceptions.HTTPError as e:
+            # Crazy but true. BaseSpace will allow access to some objects (files in this case) in a collection but not when accessed directly.
+            # We do not really have access to these and they never should have been included in the collection in the first place. Therefore
+            # ingore and move on to the next file.
+            if e.response.status_code == 403:
+                print(f"Forbidden {filename}", file=sys.stderr)
+            else:
+                self.fail(f"{filename}: {e.response.reason}")
+        except ClientError as e:
+            self.fail(f"{filename}: {e.response['Error']['Code']}")
+        except Exception as e:
+            self.fail(f"{filename}: {e}")
+        else:
+            with self._lock:
+                self.destinations.append(destination)
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        if self.errors:
+            self.callback({"name": self.name, "status": "failed", "details": "; ".join(self.errors)})
+        else:
+            self.callback({"name": self.name, "status": "complete", "destinations": sorted(self.destinations)})
+
+
+
+def import_file(client, item, samplename, identifier, output_dir, token, callback, s3_client=None, limiter=None, index=None):
+    """ Import a single file to output_dir, either a local directory or an
+        s3 url, unless it is already present. Files already imported
+        elsewhere in s3, according to index, are copied from there.
+        Returns its destination.
+    """
+    filename = item["Name"]
+    callback({"name": samplename, "status": "in-progress", "details": filename})
+    open_content = content_opener(client, item["HrefContent"], token, limiter)
+    
+    if s3_client is not None:
+        s3_bucket, s3_prefix = split_s3_url(output_dir)
+        s3_key = "/".join([s3_prefix] + identifier)
+        if s3_exists(s3_client, s3_bucket, s3_key, size=item["Size"]):
+            print(f"Skipping {filename}", file=sys.stderr)
+            return f"s3://{s3_bucket}/{s3_key}"
+
+        # Only consult the index once the file is known to be missing.
+        source = index.lookup(item) if index is not None else None
+        if source is not None:
+            print(f"Copying {filename} from s3://{source[0]}/{source[1]}", file=sys.stderr)
+            s3_copy(s3_client, source[0], source[1], s3_bucket, s3_key)
+        else:
+            print(f"Copying {filename}", file=sys.stderr)
+            stream_upload(s3_client, open_content, s3_bucket, s3_key, item["Size"])
+            if index is not None:
+                index.record(item, s3_bucket, s3_key)
+        return f"s3://{s3_bucket}/{s3_key}"
+    
+    path = os.path.join(output_dir, *identifier)
+    if not file_exists(path, size=item["Size"]):
+        print(f"Copying {filename}", file=sys.stderr)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ranged_download(open_content, path, item["Size"])
+    else:
+        print(f"Skipping {filename}", file=sys.stderr)
+    return path
 
 
 
@@ -111,18 +574,31 @@ def main():
     parser.add_argument("-a", "--appsession-bsid", help="BaseSpace id of the appsessionn responsible for creating the fastqs to be imported.", required=True)
     parser.add_argument("-o", "--output-dir", help="Path to write imported fastqs to <output-dir>/<experimentname>/<appsession-datecompleted>/<samplename>/<file.fastq>.", required=True)
     parser.add_argument("-c", "--callback", help="URL of the callback to be made to report progress.", default=None, required=False)
+    parser.add_argument("-j", "--jobs", help="Maximum number of files imported simultaneously.", type=int, default=FILE_CONCURRENCY)
+    parser.add_argument("-b", "--bandwidth", help="Maximum combined download rate in MiB/s, 0 for unlimited.", type=float, default=0)
+    parser.add_argument("-i", "--index", help="s3 url of the index of previously imported files, default s3://<output-bucket>/.bsimport/index.", default=None, required=False)
+    parser.add_argument("--no-index", help="Do not use or update the index of previously imported files.", action="store_true")
     args = parser.parse_args()
     
-    callback = post if args.callback else dont_post
-    
     S3_OUTPUT = args.output_dir[:5].lower() == "s3://"
     if S3_OUTPUT:
-        s3_bucket, s3_prefix = args.output_dir[5:].split("/", maxsplit=1)
-        s3_client = boto3.client("s3")
+        # Enough connections for every part upload of every concurrent file.
+        s3_client = boto3.client("s3", config=Config(max_pool_connections=args.jobs * (RANGE_CONCURRENCY + 1)))
+        if args.no_index:
+            index = None
+        else:
+            index = ContentIndex(s3_client, args.index or f"s3://{split_s3_url(args.output_dir)[0]}/.bsimport/index")
     elif not os.path.isdir(args.output_dir):
         sys.exit(f"output directory {args.output_dir} does not exist")
+    else:
+        s3_client = None
+        index = None
     
-    appsession = bs_get(f"{args.server}/v2/appsessions/{args.appsession_bsid}", args.token).json()
+    callback = Callbacks(args.callback)
+    client = BaseSpaceClient(pool_size=args.jobs * (RANGE_CONCURRENCY + 1))
+    limiter = TokenBucket(args.bandwidth * MiB) if args.bandwidth > 0 else None
+    
+    appsession = client.json(f"{args.server}/v2/appsessions/{args.appsession_bsid}", args.token)
     
     appsession_datecompleted = appsession["DateCompleted"] # ISO8601 with no precision beyond the second eg '2021-08-05T03:41:16.0000000Z'
     appsession_datecompleted = appsession_datecompleted.split(".")[0] # Split off meaningless trailing ".0000000Z"
@@ -139,12 +615,8 @@ def main():
                 datasets = prop["DatasetItems"]
             else:
                 # Does not specify sort direction in Output.Datasets therefore search from beginning again to be safe.
-                total = prop["ItemsTotalCount"]
                 url = f"{args.server}/v2/appsessions/{args.appsession_bsid}/properties/Output.Datasets/items"
-                while len(datasets) < total:
-                    response = bs_get(url, args.token, params={"offset": len(datasets), "SortBy": "DateCreated", "SortDir": "Desc"}).json()
-                    for item in response["Items"]:
-                        datasets.append(item["Dataset"])
+                datasets = [item["Dataset"] for item in client.items(url, args.token, params={"SortBy": "DateCreated", "SortDir": "Desc"})]
     
     samples = defaultdict(list)
     for dataset in datasets:
@@ -156,66 +628,34 @@ def main():
             # and this would significantly increase the number of api calls and complexity.
             samples[name[:-5]].append(dataset)
     
-    for samplename, datasets in samples.items():
-        if samplename in args.samplenames:
-            destinations = []
-            
-            for dataset in datasets:
-                try:
-                    remaining = 1
-                    offset = 0
-                    while remaining:
-                        response = bs_get(dataset["HrefFiles"], args.token, params={"offset": offset, "SortBy": "DateCreated", "SortDir": "Desc"}).json()
-                        paging = response["Paging"]
-                        offset = paging["Offset"]
-                        remaining = paging["TotalCount"] - offset - paging["DisplayedCount"]
-                        for item in response["Items"]:
-                            filename = item["Name"]
-                            callback(args.callback, data={"name": samplename, "status": "in-progress", "details": filename})
-                            identifier = [experimentname, appsession_datecompleted, samplename, filename]
-                            
-                            download = bs_get(item["HrefContent"], args.token)
-                            if S3_OUTPUT:
-                                s3_key = "/".join([s3_prefix] + identifier)
-                                if not s3_exists(s3_client, s3_bucket, s3_key, size=item["Size"]):
-                                    print(f"Copying {filename}", file=sys.stderr)
-                                    stream_upload(s3_client, download, s3_bucket, s3_key)
-                                else:
-                                    print(f"Skipping {filename}", file=sys.stderr)
-                                destinations.append(f"s3://{s3_bucket}/{s3_key}")
-
-                            else:
-                                path = os.path.join(args.output_dir, *identifier)
-                                if not file_exists(path, size=item["Size"]):
-                                    print(f"Copying {filename}", file=sys.stderr)
-                                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                                    with open(path, "wb") as f_out:
-                                        for chunk in download.iter_content(chunk_size=8*1024*1024): # 8MB
-                                            f_out.write(chunk)
-                                else:
-                                    print(f"Skipping {filename}", file=sys.stderr)
-                                destinations.append(path)
-                
-                except requests.exceptions.HTTPError as e:
-                    callback(args.callback, data={"name": samplename, "status": "failed", "details": e.response.reason})
-                    # Crazy but true. BaseSpace will allow access to some objects (files in this case) in a collection but not when accessed directly.
-                    # We do not really have access to these and they never should have been included in the collection in the first place. Therefore
-                    # ingore and move on to the next sample.
-                    if e.response.status_code == 403:
-                        print(f"Forbidden {samplename}", file=sys.stderr)
-                    else:
-                        raise
-
-                except ClientError as e:
-                    callback(args.callback, data={"name": samplename, "status": "failed", "details": e.response["Error"]["Code"]})
-                    raise
-
-                except Exception as e:
-                    callback(args.callback, data={"name": samplename, "status": "failed", "details": str(e)})
-                    raise
-                
-                else:
-                    callback(args.callback, data={"name": samplename, "status": "complete", "destinations": destinations})
+    # Files are listed here while earlier files are already being imported
+    # by the pool. Each sample reports itself once all of its files finish.
+    imports = []
+    with ThreadPoolExecutor(args.jobs) as executor:
+        for samplename, datasets in samples.items():
+            if samplename in args.samplenames:
+                sample = SampleImport(samplename, callback)
+                imports.append(sample)
+                for dataset in datasets:
+                    try:
+                        for item in client.items(dataset["HrefFiles"], args.token, params={"SortBy": "DateCreated", "SortDir": "Desc"}):
+                            identifier = [experimentname, appsession_datecompleted, samplename, item["Name"]]
+                            future = executor.submit(import_file, client, item, samplename, identifier, args.output_dir, args.token, callback, s3_client, limiter, index)
+                            sample.add(item["Name"], future)
+                    
+                    except requests.exceptions.HTTPError as e:
+                        if e.response.status_code == 403:
+                            print(f"Forbidden {dataset['Name']}", file=sys.stderr)
+                        else:
+                            sample.fail(f"{dataset['Name']}: {e.response.reason}")
+                    
+                    except Exception as e:
+                        sample.fail(f"{dataset['Name']}: {e}")
+                sample.listed()
+    
+    callback.close()
+    if any(sample.errors for sample in imports):
+        sys.exit(1)
 
 
 
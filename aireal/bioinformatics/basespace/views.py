@@ -6,11 +6,12 @@ import time
 import requests
 import re
 from html import escape, unescape
+from contextlib import contextmanager
 
 import pdb
 
 from flask import session, redirect, url_for, request, current_app
-from werkzeug.exceptions import Conflict, Forbidden, BadRequest, NotFound, InternalServerError
+from werkzeug.exceptions import Conflict, Forbidden, BadRequest, NotFound, InternalServerError, BadGateway, GatewayTimeout
 from jinja2 import Markup
 
 from psycopg2.extras import execute_batch
@@ -20,6 +21,7 @@ from ...utils import Cursor, Transaction, tablerow, iso8601_to_utc, demonise
 from ...i18n import _, Date, Number, Percent
 from ...aws import run_task
 from .forms import ServerForm
+from .bsclient import bs_client
 
 
 trim_lane_regex = re.compile("_L[0-9]{3}$")
@@ -41,18 +43,40 @@ def credentials(account_id):
 
 
 
-def bs_get(url, bstoken, params={}):
+@contextmanager
+def bs_errors():
+    """ Raise failed BaseSpace api requests as the matching http error.
+    """
+    unavailable = _("BaseSpace is unavailable at the present time. Please try again later.")
     try:
-        response = requests.get(url,
-                                params=params, 
-                                headers={"x-access-token": bstoken},
-                                stream=True)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException:
-        pass # need to add proper handling
-    except requests.exceptions.JSONDecodeError:
-        pass
+        yield
+    except requests.exceptions.HTTPError as e:
+        status = e.response.status_code
+        if status in (401, 403):
+            raise Forbidden(_("BaseSpace refused access. Please reauthorise the account."))
+        if status == 404:
+            raise NotFound()
+        raise BadGateway(unavailable)
+    except requests.exceptions.Timeout:
+        raise GatewayTimeout(unavailable)
+    except (requests.exceptions.RequestException, ValueError):
+        raise BadGateway(unavailable)
+
+
+
+def bs_get(url, bstoken, params={}):
+    """ GET url from the BaseSpace api and return the decoded json.
+    """
+    with bs_errors():
+        return bs_client.json(url, bstoken, params=params)
+
+
+
+def bs_items(url, bstoken, params={}):
+    """ Generator of every item of a paged BaseSpace collection.
+    """
+    with bs_errors():
+        yield from bs_client.items(url, bstoken, params=params)
 
 
 
@@ -144,7 +168,7 @@ def new_account():
     
 
 
-@app.route("/callback/authorisation/<string:token>", max_age=60*60, methods=["POST"])
+@app.route("/callback/authorisation/<string:token>", max_age=60*60, methods=["POST"], retries=3)
 def authorisation_callback(token):
     with Transaction() as trans:
         with trans.cursor() as cur:
@@ -199,15 +223,10 @@ def bsruns(account_id):
              "actions": actions}
     
     paging = query["Paging"]
-    total_count = paging["TotalCount"]
-    if paging["DisplayedCount"] < total_count:
-        pagination = []
-        offset = paging["Offset"]
-        for i in range(0, total_count, 10):
-            pagination.append({"text": str((i // 10) + 1),
-                               "href": url_for(".bsruns", account_id=account_id, run_offset=i),
-                               "current": i <= offset < i + 10})
-        table["pagination"] = pagination
+    offset = paging["Offset"]
+    end = offset + paging["DisplayedCount"]
+    table["paging"] = {"previous": url_for(".bsruns", account_id=account_id, run_offset=max(offset - 10, 0)) if offset > 0 else None,
+                       "next": url_for(".bsruns", account_id=account_id, run_offset=end) if end < paging["TotalCount"] else None}
     
     breadcrumbs = ((_("Accounts"), url_for(".accounts"), False), (account, url_for(".bsruns", account_id=account_id, run_offset=run_offset), True))
     return render_page("table.html", table=table, buttons=(), breadcrumbs=breadcrumbs)
@@ -267,12 +286,8 @@ def bsdatasets(account_id, run, appsession_bsid):
                 datasets = prop["DatasetItems"]
             else:
                 # Does not specify sort direction in Output.Datasets therefore search from beginning again to be safe.
-                total = prop["ItemsTotalCount"]
                 url = f"{server}/v2/appsessions/{appsession_bsid}/properties/Output.Datasets/items"
-                while len(datasets) < total:
-                    response = bs_get(url, bstoken, params={"offset": len(datasets), "SortBy": "DateCreated", "SortDir": "Desc"})
-                    for item in response["Items"]:
-                        datasets.append(item["Dataset"])
+                datasets = [item["Dataset"] for item in bs_items(url, bstoken, params={"SortBy": "DateCreated", "SortDir": "Desc"})]
     
     body = []
     values = []
@@ -7,7 +7,7 @@ from werkzeug import exceptions
 from ..flask import Blueprint, abort, render_page, render_template
 from ..utils import tablerow
 from ..i18n import _
-from ..aws import list_objects, cloudfront_sign_url
+from ..aws import list_objects, cloudfront_sign_url, cloudfront_sign_urls
 from .basespace import app as basespace
 
 
@@ -114,8 +114,7 @@ def igv_view(run_sample_filename):
     name = run_sample_filename.split("/")[1] if "/" in run_sample_filename else "Sample"
     
     base_url = os.path.splitext(f'https://{download_domain}/{run_sample_filename}')[0]
-    bam_url = cloudfront_sign_url(base_url+".bam", private_key)
-    bambai_url = cloudfront_sign_url(base_url+".bam.bai", private_key)
+    bam_url, bambai_url = cloudfront_sign_urls([base_url+".bam", base_url+".bam.bai"], private_key)
     #vcf_url = cloudfront_sign_url(base_url+".vcf", private_key)
     #vcftbi_url = cloudfront_sign_url(base_url+".vcf.tbi", private_key)
     back_url = url_for(".files", run_sample="/".join(run_sample_filename.split("/")[:-1]))
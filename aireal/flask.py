@@ -1,30 +1,35 @@
 import pdb
 import os
 import glob
-from functools import wraps, partial
+from functools import wraps, partial, lru_cache
 from urllib.parse import urlparse, urlunparse, parse_qs, unquote_plus, urlencode
 from collections import defaultdict, ChainMap, namedtuple
 
-from flask import session, request, url_for, current_app, redirect
+from flask import session, request, url_for, current_app, redirect, stream_with_context, Response
 from flask.sessions import SecureCookieSessionInterface
 import flask
 from werkzeug import exceptions
 
 from itsdangerous.exc import BadSignature
-from itsdangerous import URLSafeTimedSerializer
+from itsdangerous import URLSafeTimedSerializer, TimestampSigner, want_bytes
 
 from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError
 
-from .i18n import _
+from .i18n import _, format_rows
 from .forms import ActionForm
+from .utils import retry_transaction
+from .sessions import PostgresSessionInterface
 
 __all__ = ["valid_roles",
+           "role_navbar",
            "sign_token",
            "build_url"
            "Blueprint",
            "abort",
            "render_template",
            "render_page",
+           "stream_page",
            "sign_cookie",
            "unique_key",
            "iso8601_to_utc",
@@ -34,13 +39,71 @@ __all__ = ["valid_roles",
 
 
 def valid_roles():
-    return tuple(set(role.split(".")[0] for role in current_app.blueprints.keys() if role != "Auth"))
+    """ Roles of the registered blueprints. Cached per app and rebuilt only
+        if further blueprints are registered.
+    """
+    blueprints = current_app.blueprints
+    cached = current_app.extensions.get("valid_roles")
+    if cached is None or cached[0] != len(blueprints):
+        cached = (len(blueprints), tuple(set(role.split(".")[0] for role in blueprints.keys() if role != "Auth")))
+        current_app.extensions["valid_roles"] = cached
+    return cached[1]
+
+
+
+def role_navbar(role):
+    """ Left hand navbar entries for role. Built once per role, locale and
+        script root as they depend only on these, then served from a per
+        app cache. Raises KeyError if role has no navbar.
+    """
+    key = (role, session.get("locale"), request.script_root)
+    navbars = current_app.extensions.setdefault("navbars", {})
+    try:
+        return navbars[key]
+    except KeyError:
+        navbar = navbars[key] = Blueprint.navbars[role]()
+        return navbar
+
+
+
+class _CachedKeySigner(TimestampSigner):
+    """ TimestampSigner that derives the key for each secret and salt once
+        rather than on every sign and verify.
+    """
+    _keys = {}
+    
+    def derive_key(self, secret_key=None):
+        secret_key = self.secret_keys[-1] if secret_key is None else want_bytes(secret_key)
+        try:
+            return self._keys[(secret_key, self.salt)]
+        except KeyError:
+            key = self._keys[(secret_key, self.salt)] = super().derive_key(secret_key)
+            return key
+
+
+
+def _serializer(salt):
+    """ Returns the application's serializer for salt. Tokens are signed
+        with SECRET_KEY and verified against it and any keys listed in
+        SECRET_KEY_FALLBACKS, therefore SECRET_KEY can be rotated by moving
+        the old key into SECRET_KEY_FALLBACKS until its tokens expire.
+        Serializers are cached per app and salt and rebuilt if the keys
+        change.
+    """
+    config = current_app.config
+    secret_keys = (*config.get("SECRET_KEY_FALLBACKS", ()), config["SECRET_KEY"])
+    serializers = current_app.extensions.setdefault("serializers", {})
+    try:
+        return serializers[(secret_keys, salt)]
+    except KeyError:
+        serializer = URLSafeTimedSerializer(list(secret_keys), salt=salt, signer=_CachedKeySigner)
+        serializers[(secret_keys, salt)] = serializer
+        return serializer
 
 
 
 def sign_token(data, salt):
-    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt=salt)
-    return serializer.dumps(data)
+    return _serializer(salt).dumps(data)
 
 
 
@@ -54,73 +117,109 @@ def build_url(*path, **params):
 
 
 
-class _ReturnEndpoint(object):
-    # Match call signature used for route registration to extract
-    # endpoints from the lambda functions that they are stored in.
-    @staticmethod
-    def add_url_rule(rule, endpoint, view_func, **options):
-        return endpoint
+@lru_cache(maxsize=None)
+def _role(blueprint):
+    """ Role required by a blueprint, the name of its top level parent.
+    """
+    return blueprint.split(".")[0]
+
+
+
+def _token_guard(view, salt, max_age):
+    def guard(*args, **kwargs):
+        token = kwargs["token"]
+        deserialised = _validate_token(token, max_age=max_age, salt=salt)
+        if not deserialised:
+            return redirect(url_for("Auth.login"))
+        return view(*args, **{**kwargs, "token": {"token": token, **deserialised}})
+    return guard
+
+
+
+def _role_guard(view):
+    def guard(*args, **kwargs):
+        if "id" not in session:
+            return redirect(url_for("Auth.login"))
+        
+        role = _role(request.blueprint)
+        if "Auth" != role != session["role"]:
+            if request.method == "POST":
+                abort(exceptions.Forbidden)
+            else:
+                return redirect(url_for("Auth.root"))
+        
+        return view(*args, **kwargs)
+    return guard
 
 
 
 class Blueprint(flask.Blueprint):
     navbars = {}
     
-    def route(self, rule, signature=None, max_age=None, **options):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._views = {}
+    
+    
+    def route(self, rule, signature=None, max_age=None, retries=0, **options):
         """ Wrapper arounf Blueprint route with the additional positional
             argument *roles. This overides *roles in the __init__ method
             and lists all the roles allowed to access this route. Returns
             the wrapped view function that performs the following action:
             
-            1) Check that the user is logged in.
+            1) If the rule contains a /<string:token> then validate the
+               token signed with signature (default the endpoint) and no
+               older than max_age and pass its contents to the view.
+               Otherwise check that the user is logged in and has assumed
+               the correct role to access this view.
+            
+            2) Re-run the view up to retries times if a Transaction fails
+               with a serialization failure or deadlock. See
+               utils.retry_transaction.
             
-            2) Check that the user has assumed the correct role to access
-               this view.
+            3) Catch IntegrityErrors and TransactionRollbackErrors caused by
+               simultaneous attemps to write the same rows in the databse.
             
-            3) Catch IntegrityErrors caused by simultaneous attemps to
-               write the same rows in the databse.
+            Whether the route is token or role authenticated is decided
+            here rather than per request. Routes may be stacked on the same
+            view, each with its own authentication, signature, max_age and
+            retries, as the single registered view dispatches on the rule
+            that matched.
         """
         
         def decorator(function):
-            """ Check if the function has already been registered and therefore
-                already wrapped. If so then just return it unmodified. WARNING
-                This depends on private internals of the Blueprint which could
-                potentialy change in future versions.
-            """
             endpoint = options.pop("endpoint", None) or function.__name__
-
-            for registration_function in self.deferred_functions:
-                try:
-                    if registration_function(_ReturnEndpoint) == endpoint:
-                        wrapper = function
-                        break
-                except Exception:
-                    pass
             
-            else:
+            wrapper = self._views.get(endpoint)
+            if wrapper is None:
+                guards = {}
+                
                 @wraps(function)
                 def wrapper(*args, **kwargs):
-                    if "/<string:token>" in request.url_rule.rule:
-                        token = kwargs["token"]
-                        deserialised = _validate_token(token, max_age=max_age, salt=signature or endpoint)
-                        if not deserialised:
-                            return redirect(url_for("Auth.login"))
-                        kwargs["token"] = {"token": token, **deserialised}
-                    
-                    elif "id" not in session:
-                        return redirect(url_for("Auth.login"))
-                    
-                    elif "Auth" != request.blueprint.split(".")[0] != session["role"]:
-                        if request.method == "POST":
-                            abort(exceptions.Forbidden)
-                        else:
-                            return redirect(url_for("Auth.root"))
-                    
                     try:
-                        return function(*args, **kwargs)
-                    except IntegrityError:
+                        return guards[request.url_rule.rule](*args, **kwargs)
+                    except (IntegrityError, TransactionRollbackError):
                         abort(exceptions.Conflict)
+                
+                wrapper.guards = guards
+                wrapper.view = function
+                self._views[endpoint] = wrapper
             
+            view = retry_transaction(retries)(wrapper.view) if retries else wrapper.view
+            if "/<string:token>" in rule:
+                guard = _token_guard(view, signature or endpoint, max_age)
+            else:
+                guard = _role_guard(view)
+            
+            # The rule only becomes final once the blueprint is registered
+            # and any url_prefix applied.
+            def register_guard(state):
+                full_rule = rule
+                if state.url_prefix is not None:
+                    full_rule = "/".join((state.url_prefix.rstrip("/"), rule.lstrip("/"))) if rule else state.url_prefix
+                wrapper.guards[full_rule] = guard
+            
+            self.record(register_guard)
             self.add_url_rule(rule, endpoint, wrapper, **options)
             return wrapper
         return decorator
@@ -133,51 +232,99 @@ class Blueprint(flask.Blueprint):
 
 def _validate_token(token, max_age=0, salt=None):
     if token:
-        secret = current_app.config["SECRET_KEY"]
-        s = URLSafeTimedSerializer(secret, salt=salt)
         try:
-            return s.loads(token, max_age=max_age)
+            return _serializer(salt).loads(token, max_age=max_age)
         except BadSignature:
             pass
     return {}
 
 
 
-def render_template(template_name, style=None, **kwargs):
-    """ Adds correct prefix to template supplied to flask.render_template.
-        Enables swapping of css styles on the fly.
-    """
+def _styled(template_name, style=None):
     if style is None:
         style = current_app.config.get("STYLE", None)
     if style is not None:
         template_name = f"{style}/{template_name}"
-    return flask.render_template(template_name, **kwargs)
+    return template_name
 
 
 
-def render_page(name, active=None, **context):
-    """ Wrapper around flask.render_template to add appropriate navbar context
-        before calling flask.render_template itself. To be used instead of 
-        flask.render_template when rendering a full page. Not to be used for
-        ajax calls for dropdowns etc.
+def render_template(template_name, style=None, **kwargs):
+    """ Adds correct prefix to template supplied to flask.render_template.
+        Enables swapping of css styles on the fly.
+    """
+    return flask.render_template(_styled(template_name, style), **kwargs)
+
+
+
+def stream_template(template_name, style=None, **kwargs):
+    """ As render_template but returns a streamed response. Any generators
+        within kwargs are consumed as the response is sent with the request
+        context preserved.
     """
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_template(_styled(template_name, style))
+    app.update_template_context(kwargs)
+    stream = template.stream(**kwargs)
+    stream.enable_buffering(100)
+    return Response(stream_with_context(stream))
+
+
+
+def _page_context(active):
     config = current_app.config
     application = config.get("NAME", "")
     if "id" not in session:
         navbar = {"app": application}
     else:
+        urls = current_app.extensions.setdefault("navbar_urls", {})
+        try:
+            project_url, logout_url = urls[request.script_root]
+        except KeyError:
+            project_url, logout_url = urls[request.script_root] = (url_for("Auth.project_menu"), url_for("Auth.logout_menu"))
         right = [{"text": session.get("project", ""),
-                  "href": url_for("Auth.project_menu"),
+                  "href": project_url,
                   "dropdown": True},
                  {"text": "",
-                  "href": url_for("Auth.logout_menu"),
+                  "href": logout_url,
                   "dropdown": True}]
         navbar = {"app": application,
                   "name": _(session.get("role", "")),
                   "active": active,
-                  "left": Blueprint.navbars[session["role"]](),
+                  "left": role_navbar(session["role"]),
                   "right": right}
-    return render_template(name, navbar=navbar, table_form=ActionForm(id="table-form"), **context)
+    return {"navbar": navbar, "table_form": ActionForm(id="table-form")}
+
+
+
+def _format_table(context):
+    # Format the cells of the table body in one pass before rendering.
+    table = context.get("table")
+    if isinstance(table, dict) and table.get("body") is not None:
+        body = format_rows(table["body"])
+        if isinstance(table["body"], (list, tuple)):
+            body = list(body)
+        context["table"] = {**table, "body": body}
+    return context
+
+
+
+def render_page(name, active=None, **context):
+    """ Wrapper around flask.render_template to add appropriate navbar context
+        before calling flask.render_template itself. To be used instead of 
+        flask.render_template when rendering a full page. Not to be used for
+        ajax calls for dropdowns etc.
+    """
+    return render_template(name, **_page_context(active), **_format_table(context))
+
+
+
+def stream_page(name, active=None, **context):
+    """ As render_page but the page is streamed. Intended for tables whose
+        body is a generator, eg built from utils.stream_rows, so that rows
+        are rendered as they are fetched rather than accumulated first.
+    """
+    return stream_template(name, **_page_context(active), **_format_table(context))
 
 
 
@@ -187,6 +334,12 @@ def abort(exc):
 
 
 def flask_cookie(data):
+    """ Returns a session cookie value that will load data as the session,
+        for whichever session interface the app uses.
+    """
+    interface = current_app.session_interface
+    if isinstance(interface, PostgresSessionInterface):
+        return interface.dumps(current_app, data)
     session_serializer = SecureCookieSessionInterface() \
                          .get_signing_serializer(current_app)
     return session_serializer.dumps(dict(data))
@@ -4,8 +4,8 @@ from html import escape
 from jinja2 import Markup
 from flask import session
 
-from .flask import render_page
-from .utils import Cursor
+from .flask import stream_page
+from .paging import Paginator
 from .i18n import _, Date, format_decimal, format_unit, format_percent
 
 
@@ -25,29 +25,33 @@ def format_val(val):
 
 
 
+def audit_row(action, name, keyvals, format_string, when, user):
+    if format_string:
+        translated = {k: format_val(v) for k, v in keyvals.items()}
+        details = format_string.format(**translated)
+    else:
+        translated = {_(k): format_val(v) for k, v in keyvals.items()}
+        details = Markup("<br>".join(escape(" = ".join(kv)) for kv in sorted(translated.items())))
+    return ((name,
+             _(action),
+             details,
+             user,
+             Date(when)), {})
+
+
+
 def audit_view(tablename, row_id, url_back, title=""):
-    sql = """SELECT audittrail.action, audittrail.name, audittrail.keyvals, audittrail.format_string, audittrail.datetime, users.name
+    sql = """SELECT audittrail.id, audittrail.action, audittrail.name, audittrail.keyvals, audittrail.format_string, audittrail.datetime, users.name AS username
              FROM audittrail
              JOIN users ON audittrail.users_id = users.id
              JOIN auditlink ON auditlink.audittrail_id = audittrail.id
-             WHERE auditlink.tablename = %(tablename)s AND auditlink.row_id = %(row_id)s
-             ORDER BY audittrail.datetime;"""
-    body = []
-    with Cursor() as cur:
-        cur.execute(sql, {"tablename": tablename, "row_id": row_id})
-        for action, name, keyvals, format_string, when, user in cur:
-            if format_string:
-                translated = {k: format_val(v) for k, v in keyvals.items()}
-                details = format_string.format(**translated)
-            else:
-                translated = {_(k): format_val(v) for k, v in keyvals.items()}
-                details = Markup("<br>".join(escape(" = ".join(kv)) for kv in sorted(translated.items())))
-            body.append(((name,
-                          _(action),
-                          details,
-                          user,
-                          Date(when)), {}))
+             WHERE auditlink.tablename = %(tablename)s AND auditlink.row_id = %(row_id)s"""
+    paging = Paginator(sql, {"tablename": tablename, "row_id": row_id},
+                       columns=("name", "action", None, "username", "datetime"),
+                       searchable=("name", "action", "username"),
+                       default="datetime")
     table = {"head": (_("Name"), _("Action"), _("Details"), _("User"), _("Date")), 
-             "body": body}
+             "body": (audit_row(*row[1:]) for row in paging.rows()),
+             "paging": paging}
     buttons={"back": (_("Back"), url_back)}
-    return render_page("table.html", table=table, buttons=buttons, title=title)
+    return stream_page("table.html", table=table, buttons=buttons, title=title)
@@ -1,5 +1,7 @@
 import os
+import pickle
 import importlib
+from functools import lru_cache, partial
 import pdb
 
 from pytz import timezone
@@ -10,24 +12,51 @@ from babel.messages.pofile import read_po
 from babel.units import UnknownUnitError, _find_unit_pattern, get_unit_name
 from babel.core import Locale
 
-from flask import current_app, session, request
+from flask import current_app, session, request, has_request_context
+from flask.globals import _cv_request # Private, but resolves the request once rather than the app and session proxies per lookup
+from markupsafe import escape
 
 
 
-def format_unit(value, measurement_unit, length="short", locale=LC_NUMERIC, frac_prec=None):
-    locale = Locale.parse(locale)
+@lru_cache(maxsize=None)
+def _locale(identifier):
+    return Locale.parse(identifier)
+
+
+
+@lru_cache(maxsize=None)
+def _timezone(name):
+    return timezone(name)
 
-    q_unit = _find_unit_pattern(measurement_unit, locale=locale)
+
+
+@lru_cache(maxsize=256)
+def _decimal_pattern(locale, frac_prec):
+    pattern = parse_pattern(_locale(locale).decimal_formats.get(None))
+    if frac_prec is not None:
+        pattern.frac_prec = (0, frac_prec)
+    return pattern
+
+
+
+@lru_cache(maxsize=256)
+def _unit_patterns(locale, measurement_unit, length):
+    q_unit = _find_unit_pattern(measurement_unit, locale=_locale(locale))
     if not q_unit:
         raise UnknownUnitError(unit=measurement_unit, locale=locale)
-    unit_patterns = locale._data["unit_patterns"][q_unit].get(length, {})
+    return _locale(locale)._data["unit_patterns"][q_unit].get(length, {})
+
+
+
+def format_unit(value, measurement_unit, length="short", locale=LC_NUMERIC, frac_prec=None):
+    unit_patterns = _unit_patterns(str(locale), measurement_unit, length)
 
     if isinstance(value, str):  # Assume the value is a preformatted singular.
         formattedvalue = value
         plural_form = "one"
     else:
-        formattedvalue = format_decimal(value, locale, frac_prec)
-        plural_form = locale.plural_form(value)
+        formattedvalue = format_decimal(value, locale, frac_prec=frac_prec)
+        plural_form = _locale(str(locale)).plural_form(value)
 
     if plural_form not in unit_patterns:
         # The current CLDR has no way for this to happen.
@@ -38,13 +67,47 @@ def format_unit(value, measurement_unit, length="short", locale=LC_NUMERIC, frac
 
 
 def format_decimal(value, locale=LC_NUMERIC, decimal_quantization=True, group_separator=True, frac_prec=None):
-    locale = Locale.parse(locale)
+    pattern = _decimal_pattern(str(locale), frac_prec)
+    return pattern.apply(value, _locale(str(locale)), decimal_quantization=decimal_quantization, group_separator=group_separator)
+
+
+
+@lru_cache(maxsize=256)
+def date_formatter(locale, tz, format="medium"):
+    """ Returns a function that formats a datetime in timezone tz and locale
+        with format. Cached, therefore the locale, timezone and patterns
+        are only parsed once per combination.
+    """
+    tzinfo = _timezone(tz)
+    babel_locale = _locale(locale)
     
-    format = locale.decimal_formats.get(None)
-    pattern = parse_pattern(format)
-    if frac_prec is not None:
-        pattern.frac_prec = (0, frac_prec)
-    return pattern.apply(value, locale, decimal_quantization=decimal_quantization, group_separator=group_separator)
+    def formatter(val):
+        dt = val.astimezone(tzinfo)
+        ret = format_datetime(dt, format=format, locale=babel_locale)
+        if format != "long":
+            ret = "{} {}".format(ret, dt.strftime("%Z"))
+        return ret
+    return formatter
+
+
+
+@lru_cache(maxsize=256)
+def number_formatter(locale, units=None):
+    """ Returns a function that formats a number in locale, with units if
+        given. Cached as per date_formatter.
+    """
+    if units is None:
+        return partial(format_decimal, locale=locale)
+    return partial(format_unit, measurement_unit=units, locale=locale)
+
+
+
+@lru_cache(maxsize=256)
+def percent_formatter(locale):
+    """ Returns a function that formats a percentage in locale. Cached as
+        per date_formatter.
+    """
+    return partial(format_percent, locale=_locale(locale), decimal_quantization=False)
 
 
 
@@ -64,24 +127,117 @@ def i18n_nop(text):
 
 
 
-def _(text):
-    try:
-        return current_app.extensions["locales"][session["locale"]][text]
-    except KeyError:
+class LazyString(str):
+    """ Translatable string returned by _ outside of a request, eg at module
+        level. As a str subclass it can be used anywhere a str is expected,
+        where it behaves as the untranslated text, eg as a query parameter,
+        in json or as a dict key. It is translated into the locale of the
+        request in which it is used whenever it is converted to a str,
+        formatted, rendered in a template or concatenated.
+    """
+    def __new__(cls, text):
+        lazy = super().__new__(cls, text)
+        lazy.unlocalised = text
+        return lazy
+    
+    def __str__(self):
+        return _lookup(self.unlocalised)
+    
+    def __html__(self):
+        return escape(str(self))
+    
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+    
+    def __repr__(self):
+        return f"LazyString({self.unlocalised!r})"
+    
+    def __add__(self, other):
+        return str(self) + other
+    
+    def __radd__(self, other):
+        return other + str(self)
+    
+    def __mod__(self, other):
+        return str(self) % other
+    
+    def __getnewargs__(self):
+        return (self.unlocalised,)
+
+
+
+def _catalog(ctx):
+    """ Message catalog of the session locale of the request context ctx,
+        or if the user has not chosen one, eg before login, of the locale
+        negotiated from the browser headers. Looked up on every call, which
+        is only a couple of dict lookups, so that it always follows the
+        session locale, eg after setlocale or session.clear().
+    """
+    catalogs = ctx.app.extensions.get("locales", {})
+    locale = ctx.session.get("locale")
+    catalog = catalogs.get(locale) if locale else None
+    if catalog is None:
+        catalog = catalogs.get(locale_from_headers(), {})
+    return catalog
+
+
+
+def _lookup(text):
+    ctx = _cv_request.get(None)
+    if ctx is None:
         return text
+    return _catalog(ctx).get(text, text)
+
+
+
+def _(text):
+    ctx = _cv_request.get(None)
+    if ctx is None:
+        return LazyString(text)
+    return _catalog(ctx).get(text, text)
     
     
 
 def __(text):
-    try:
-        translated = AnnotatedStr(current_app.extensions["locales"][session["locale"]][text])
-    except KeyError:
-        translated = AnnotatedStr(text)
+    if not has_request_context():
+        return LazyString(text)
+    translated = AnnotatedStr(_lookup(text))
     translated.unlocalised = text
     return translated
     
     
 
+def _load_catalog(po_file, cache_file):
+    """ Returns the translations within po_file as a dict. The parsed
+        catalog is pickled to cache_file and reused for as long as the
+        modification time and size of po_file are unchanged.
+    """
+    stat = os.stat(po_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, translations = pickle.load(f)
+        if cached_key == key:
+            return translations
+    except Exception: # Missing, stale format or corrupt, rebuild
+        pass
+    
+    with open(po_file, encoding="utf-8-sig") as f: # Strip any byte order mark
+        catalog = read_po(f)
+    translations = {message.id: message.string for message in catalog if message.id and message.string}
+    
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            pickle.dump((key, translations), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError: # Instance folder not writable, cache is optional
+        pass
+    return translations
+
+
+
 def i18n_init(app):
     package = importlib.import_module(app.import_name)
     root_dir = os.path.dirname(package.__file__)
@@ -94,14 +250,8 @@ def i18n_init(app):
     for locale in os.listdir(locales_dir):        
         po_file = os.path.join(locales_dir, locale, "LC_MESSAGES", f"{locale}.po")
         if os.path.exists(po_file):
-            # TODO fix warning
-            with open(po_file) as f:
-                catalog = read_po(f)
-                
-            translations[locale] = {}
-            for message in catalog:
-                if message.id and message.string:
-                    translations[locale][message.id] = message.string
+            cache_file = os.path.join(app.instance_path, "catalogs", f"{locale}.pickle")
+            translations[locale] = _load_catalog(po_file, cache_file)
                                 
     if "en_GB" not in translations:
         translations["en_GB"] = {}
@@ -110,31 +260,81 @@ def i18n_init(app):
     
     
 
+@lru_cache(maxsize=512)
+def negotiate_locale(accept_header, available, default="en_GB"):
+    """ Returns the locale within available that best matches an
+        Accept-Language header, eg en-GB,en-US;q=0.9,en;q=0.8, using RFC
+        4647 lookup, otherwise default. Language ranges are tried in
+        descending order of q, those with q=0 are not acceptable. Each range
+        is progressively truncated, en-GB-oxendict then en-GB then en,
+        until one matches. Cached as the same few headers recur.
+    
+    Args:
+        accept_header:
+            Accept-Language header.
+        available:
+            frozenset of supported locales eg {"en_GB", "fr"}.
+        default:
+            Locale if there is no match.
+    
+    Returns:
+        Locale.
+    """
+    lookup = {locale.lower().replace("_", "-"): locale for locale in available}
+    ranges = []
+    for position, token in enumerate(accept_header.split(",")):
+        lang, _sep, params = token.partition(";")
+        lang = lang.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _sep, val = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if lang and lang != "*" and q > 0:
+            ranges.append((-q, position, lang))
+    
+    for _q, _position, lang in sorted(ranges):
+        subtags = lang.split("-")
+        while subtags:
+            tag = "-".join(subtags)
+            if tag in lookup:
+                return lookup[tag]
+            subtags.pop()
+            # A single character subtag is never left on the end.
+            if subtags and len(subtags[-1]) == 1:
+                subtags.pop()
+    return default
+
+
+
 def locale_from_headers():
-    """ Parse the browser Acept-Language header and return the supported locale 
-        that has the highest q score. Default to en_GB if none of the requested
-        locales are supported. Header format = en-GB,en-US;q=0.9,en;q=0.8
+    """ Return the supported locale that best matches the browser
+        Accept-Language header. Default to en_GB if none of the requested
+        locales are supported. See negotiate_locale.
     """
-    try: # We cannot trust any browser input therefore catch everything
-        locales = current_app.extensions["locales"]
-        accept_header = request.headers.get("Accept-Language", "")
-        weighted_lang = [token.strip().split(";q=") for token in accept_header.split(",")]
-        sorted_lang = sorted(weighted_lang, key=lambda x:float(x[1]) if len(x)>1 else 1.0, reverse=True)
-        for lang_q in sorted_lang:
-            lang = lang_q[0]
-            locale = "_".join(lang.split("-")[:2])
-            if locale in locales:
-                return locale
-    except Exception:
-        pass
-    return "en_GB"
+    available = current_app.extensions.get("available_locales")
+    if available is None:
+        available = current_app.extensions["available_locales"] = frozenset(current_app.extensions.get("locales", ()))
+    return negotiate_locale(request.headers.get("Accept-Language", ""), available)
 
 
 
 class Wrapper(object):
+    """ Base class of values that are formatted for the locale and timezone
+        of the session when rendered. Subclasses implement formatter(locale,
+        tz) to return a, preferably cached, function that formats self.val.
+    """
     def __str__(self):
         return self.__html__()
     
+    def __html__(self):
+        if self.val is None:
+            return ""
+        return self.formatter(session["locale"], session.get("timezone"))(self.val)
+    
     @property
     def value(self):
         if self.val is None:
@@ -157,17 +357,8 @@ class Date(Wrapper):
                                           repr(self.val),
                                           repr(self.format))
     
-    def __html__(self):
-        if self.val is None:
-            return ""
-        tz = timezone(session["timezone"])
-        dt = self.val.astimezone(tz)
-        ret = format_datetime(dt, 
-                              format=self.format,
-                              locale=session["locale"])
-        if self.format != "long":
-            ret = "{} {}".format(ret, dt.strftime("%Z"))
-        return ret
+    def formatter(self, locale, tz):
+        return date_formatter(locale, tz, self.format)
     
     @property
     def value(self):
@@ -193,13 +384,8 @@ class Number(Wrapper):
     def __repr__(self):
         return "{}({}, units={})".format(type(self).__name__, repr(self.val), repr(self.units))
     
-    def __html__(self):
-        if self.val is None:
-            return ""
-        elif self.units is None:
-            return format_decimal(self.val, locale=session["locale"])
-        else:
-            return format_unit(self.val, self.units, locale=session["locale"])
+    def formatter(self, locale, tz):
+        return number_formatter(locale, self.units)
 
 
 
@@ -219,10 +405,44 @@ class Percent(Wrapper):
     def __repr__(self):
         return "{}({})".format(type(self).__name__, repr(self.val))
         
-    def __html__(self):
-        if self.val is None:
-            return ""
-        return format_percent(self.val, locale=session["locale"], decimal_quantization=False)
+    def formatter(self, locale, tz):
+        return percent_formatter(locale)
+
+
+
+class FormattedCell(str):
+    """ Table cell formatted ahead of rendering by format_rows. Retains the
+        sort value of the Wrapper it was formatted from.
+    """
+    def __new__(cls, text, value):
+        cell = super().__new__(cls, text)
+        cell.value = value
+        return cell
+
+
+
+def format_rows(rows):
+    """ Generator that formats every Wrapper cell within the rows of a table
+        body, as built by tablerow, in a single pass. The session locale and
+        timezone are looked up once and each cell's text and sort value are
+        computed exactly once, rather than when the template renders the
+        cell and again for each access of its value. Must be consumed within
+        the request, eg within a streamed response.
+    
+    Args:
+        rows:
+            Iterable of (cells, attributes).
+    
+    Returns:
+        Generator of (cells, attributes) with Wrappers replaced by
+        FormattedCells.
+    """
+    locale = session.get("locale")
+    tz = session.get("timezone")
+    for cells, attr in rows:
+        yield ([FormattedCell("" if cell.val is None else cell.formatter(locale, tz)(cell.val), cell.value)
+                if isinstance(cell, Wrapper) else cell for cell in cells],
+               attr)
 
 
 
@@ -1,7 +1,12 @@
 import pdb
 from collections import defaultdict
+from datetime import datetime, timezone
+from functools import partial
 
 from flask import session, request
+from psycopg2.extras import execute_values
+
+from .audit import audit_sink
 
 
 
@@ -50,24 +55,18 @@ def record_form(cur, tablename, action, row_id, form, old={}):
 
     deleted = edited.pop("deleted", None)
     
-    sql = """INSERT INTO editrecord (tablename, row_id, action, details, users_id, ip_address)
-             VALUES (%(tablename)s, %(row_id)s, %(action)s, %(details)s, %(users_id)s, %(ip_address)s);"""
-    values = {"tablename": tablename,
-              "row_id": row_id,
-              "users_id": session.get("id", None),
-              "ip_address": request.remote_addr}
-    
+    actions = []
     if edited:
-        cur.execute(sql, {"action": action, "details": edited, **values})
-    
+        actions.append((action, edited))
     if added:
-        cur.execute(sql, {"action": "Added", "details": added, **values})
-    
+        actions.append(("Added", added))
     if removed:
-        cur.execute(sql, {"action": "Removed", "details": removed, **values})
-    
+        actions.append(("Removed", removed))
     if deleted is not None:
-        cur.execute(sql, {"action": "Deleted" if deleted else "Restored", **values})
+        actions.append(("Deleted" if deleted else "Restored", {}))
+    
+    if actions:
+        insert_editrecords(cur, tablename, row_id, actions)
     
     return row_id
     _("Created")
@@ -136,13 +135,7 @@ def perform_delete(cur, tablename, row_id, pk="id"):
     sql = f"UPDATE {tablename} SET deleted = true WHERE deleted = false AND {pk} = %(row_id)s;"
     cur.execute(sql, {"row_id": row_id})
     if cur.rowcount:
-        sql = """INSERT INTO editrecord (tablename, row_id, action, users_id, ip_address)
-                 VALUES (%(tablename)s, %(row_id)s, %(action)s, %(users_id)s, %(ip_address)s);"""
-        cur.execute(sql, {"tablename": tablename,
-                          "row_id": row_id,
-                          "action": "Deleted",
-                          "users_id": session.get("id", None),
-                          "ip_address": request.remote_addr})
+        insert_editrecords(cur, tablename, row_id, [("Deleted", {})])
     
     
     
@@ -150,14 +143,24 @@ def perform_restore(cur, tablename, row_id, pk="id"):
     sql = f"UPDATE {tablename} SET deleted = false WHERE deleted = true AND {pk} = %(row_id)s;"
     cur.execute(sql, {"row_id": row_id})
     if cur.rowcount:
-        sql = """INSERT INTO editrecord (tablename, row_id, action, users_id, ip_address)
-                 VALUES (%(tablename)s, %(row_id)s, %(action)s, %(users_id)s, %(ip_address)s);"""
-        cur.execute(sql, {"tablename": tablename,
-                          "row_id": row_id,
-                          "action": "Restored",
-                          "users_id": session.get("id", None),
-                          "ip_address": request.remote_addr})
-    
-    
-    
-
+        insert_editrecords(cur, tablename, row_id, [("Restored", {})])
+    
+    
+    
+def insert_editrecords(cur, tablename, row_id, actions):
+    """ Record a list of (action, details) against a row in editrecord
+        with a single insert, or if the audit sink is enabled hand them to
+        it once the transaction has committed.
+    """
+    users_id = session.get("id", None)
+    ip_address = request.remote_addr
+    sink = audit_sink()
+    if sink is not None:
+        edit_datetime = datetime.now(timezone.utc).isoformat()
+        for action, details in actions:
+            row = (tablename, row_id, action, details, users_id, ip_address, edit_datetime)
+            cur.connection.after_commit(partial(sink.put, "editrecord", row))
+    else:
+        sql = """INSERT INTO editrecord (tablename, row_id, action, details, users_id, ip_address)
+                 VALUES %s;"""
+        execute_values(cur, sql, [(tablename, row_id, action, details, users_id, ip_address) for action, details in actions])
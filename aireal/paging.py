@@ -0,0 +1,177 @@
+import pdb
+
+from flask import request, url_for
+
+from .utils import Cursor
+
+__all__ = ["Paginator"]
+
+
+
+class Paginator(object):
+    """ Server side keyset (seek) pagination, sorting and filtering of the
+        SQL behind a table view.
+
+    The view's query is wrapped in an outer query that filters, orders by
+    the requested sort column followed by key and seeks past the last row
+    of the previous page, so each page costs O(page) however large the
+    table. The state is carried in the query string parameters sort, desc,
+    q, after/after_key (next page) and before/before_key (previous page).
+
+    Pass the Paginator to table.html as table["paging"] and iterate
+    rows() to build the body. The next and previous links are only known
+    once rows() has been consumed, which table.html does before it renders
+    them, therefore rows() may be used lazily within a streamed page.
+
+    Args:
+        sql:
+            Query without ORDER BY or trailing semicolon. Every column must
+            have a unique name and sortable columns must be NOT NULL.
+        params:
+            Query parameters.
+        columns:
+            Sequence, one per column of the table head, of the column name
+            that column may be sorted by or None if it cannot be sorted.
+        searchable:
+            Column names matched case insensitively against the q parameter.
+        default:
+            Column name to sort by if none is requested.
+        page_size:
+            Rows per page.
+        key:
+            Unique NOT NULL column used to break ties between equal sort
+            values.
+    """
+    def __init__(self, sql, params={}, columns=(), searchable=(), default=None, page_size=50, key="id"):
+        self.sql = sql.strip().rstrip(";")
+        self.params = dict(params)
+        self.columns = tuple(columns)
+        self.searchable = tuple(searchable)
+        self.page_size = page_size
+        self.key = key
+
+        args = request.args
+        sortable = [col for col in self.columns if col]
+        sort = args.get("sort", "")
+        self.sort = sort if sort in sortable else (default or key)
+        self.desc = args.get("desc", "") == "1"
+        self.filter = args.get("q", "").strip()
+        self.after = (args["after"], args["after_key"]) if "after" in args and "after_key" in args else None
+        self.before = (args["before"], args["before_key"]) if "before" in args and "before_key" in args else None
+
+        self._first = None
+        self._last = None
+        self._more = False
+
+
+    def _query(self):
+        conditions = []
+        params = dict(self.params)
+        if self.filter and self.searchable:
+            escaped = self.filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params["_paging_filter"] = f"%{escaped}%"
+            conditions.append("({})".format(" OR ".join(f"paged.{col}::text ILIKE %(_paging_filter)s" for col in self.searchable)))
+
+        # Seeking backwards reverses the order and the page is flipped back after fetching.
+        backwards = self.before is not None
+        descending = self.desc != backwards
+        seek = self.before if backwards else self.after
+        if seek is not None:
+            params["_paging_sort"], params["_paging_key"] = seek
+            operator = "<" if descending else ">"
+            conditions.append(f"(paged.{self.sort}, paged.{self.key}) {operator} (%(_paging_sort)s, %(_paging_key)s)")
+
+        direction = "DESC" if descending else "ASC"
+        where = "WHERE {}".format(" AND ".join(conditions)) if conditions else ""
+        sql = f"""SELECT *
+                  FROM ({self.sql}) AS paged
+                  {where}
+                  ORDER BY paged.{self.sort} {direction}, paged.{self.key} {direction}
+                  LIMIT {self.page_size + 1};"""
+        return sql, params
+
+
+    def rows(self):
+        """ Generator of the rows of the current page. Fetched through a
+            server side cursor so that rows are only read as they are
+            consumed, except when paging backwards as the page must then be
+            reversed.
+        """
+        sql, params = self._query()
+        with Cursor(name=True, itersize=self.page_size + 1) as cur:
+            cur.execute(sql, params)
+            if self.before is not None:
+                rows = cur.fetchall()
+                self._more = len(rows) > self.page_size
+                rows = rows[:self.page_size]
+                rows.reverse()
+            else:
+                rows = cur
+            
+            indices = None
+            for n, row in enumerate(rows):
+                if n == self.page_size:
+                    self._more = True
+                    break
+                if indices is None:
+                    names = [col.name for col in cur.description]
+                    indices = (names.index(self.sort), names.index(self.key))
+                position = tuple(str(row[i]) for i in indices)
+                if n == 0:
+                    self._first = position
+                self._last = position
+                yield row
+
+
+    def url(self, **changes):
+        """ Url of the current view with the paging parameters changed.
+            Parameters set to None are removed.
+        """
+        args = {**request.args.to_dict(), **request.view_args, **changes}
+        return url_for(request.endpoint, **{k: v for k, v in args.items() if v is not None})
+
+
+    def _seek(self, direction, position):
+        reset = {"after": None, "after_key": None, "before": None, "before_key": None}
+        sort, key = position
+        return self.url(**{**reset, direction: sort, f"{direction}_key": key})
+
+
+    @property
+    def next(self):
+        """ Url of the next page, or None if this is the last.
+        """
+        if self._last is not None and (self._more or self.before is not None):
+            return self._seek("after", self._last)
+
+
+    @property
+    def previous(self):
+        """ Url of the previous page, or None if this is the first.
+        """
+        if self._first is not None and (self.after is not None or (self.before is not None and self._more)):
+            return self._seek("before", self._first)
+
+
+    @property
+    def sort_urls(self):
+        """ List, one per column, of the url that sorts the table by that
+            column or None if the column is not sortable. Selecting the
+            current sort column reverses the direction.
+        """
+        urls = []
+        for col in self.columns:
+            if col:
+                desc = "0" if col != self.sort or self.desc else "1"
+                urls.append(self.url(sort=col, desc=desc, after=None, after_key=None, before=None, before_key=None))
+            else:
+                urls.append(None)
+        return urls
+
+
+    @property
+    def filter_url(self):
+        """ Url to submit the filter form to. The form supplies q along with
+            sort and desc as hidden fields and restarts from the first page.
+        """
+        return url_for(request.endpoint, **{k: v for k, v in request.view_args.items() if v is not None})
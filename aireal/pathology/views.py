@@ -3,6 +3,7 @@ from itertools import count
 import re
 import time
 import json
+import zlib
 import pdb
 
 from psycopg2.errors import UniqueViolation
@@ -13,11 +14,13 @@ from werkzeug import exceptions
 from urllib.parse import quote
 
 from ..utils import Cursor, Transaction, tablerow, unique_key, dict_from_select
-from ..flask import abort, render_template, Blueprint, sign_token, build_url, render_page
+from ..paging import Paginator
+from ..flask import abort, render_template, Blueprint, sign_token, build_url, render_page, stream_page
 from ..logic import perform_edit, perform_delete, perform_restore
+from ..audit import record_event
 from ..view_helpers import log_table
 from ..i18n import _, Date, Number
-from ..aws import list_objects, s3_sign_url, run_task, cloudfront_sign_cookies, cloudfront_sign_url
+from ..aws import list_objects, s3_sign_url, run_task, cloudfront_cached_cookies, cloudfront_sign_url
 from ..forms import ActionForm
 
 from .forms import DirectoryUploadForm, AjaxForm, Form, CompletionForm, SlideForm
@@ -30,6 +33,9 @@ def pathology_navbar():
   
 
 
+TILES_MARKER_COOKIE = "tiles_cookies"
+TILES_MARKER_MARGIN = 5*60
+
 Blueprint.navbars["Pathology"] = pathology_navbar
 app = Blueprint("Pathology", __name__, template_folder="templates")
   
@@ -37,33 +43,32 @@ app = Blueprint("Pathology", __name__, template_folder="templates")
 
 @app.route("/slides")
 def slide_list():
-    sql = """SELECT slide.id, slide.name, users.fullname, pathologysite.name, slide.created_datetime, slide.status, slide.deleted, slide.clinical_details
+    sql = """SELECT slide.id, slide.name, users.fullname AS uploaded_by, coalesce(pathologysite.name, '') AS site, slide.created_datetime, slide.status, slide.deleted, slide.clinical_details
              FROM slide
              INNER JOIN users ON users.id = slide.users_id
-             LEFT OUTER JOIN pathologysite ON pathologysite.id = slide.pathologysite_id
-             ORDER BY slide.name;"""
+             LEFT OUTER JOIN pathologysite ON pathologysite.id = slide.pathologysite_id"""
+    paging = Paginator(sql,
+                       columns=("name", "site", "uploaded_by", "created_datetime", "clinical_details", "status"),
+                       searchable=("name", "site", "uploaded_by", "clinical_details", "status"),
+                       default="name")
 
     head=(_("Slide"), _("Site"), _("Uploaded By"), _("Date Uploaded"), _("Clinical Details"), _("Status"))
-    body = []
-    with Cursor() as cur:
-        cur.execute(sql, {"project_id": session.get("project_id")})
-        for slide_id, slide, user, pathologysite, created_datetime, status, deleted, clinical_details in cur:
-            body.append(tablerow(slide,
-                                 pathologysite,
-                                 user,
-                                 Date(created_datetime),
-                                 clinical_details,
-                                 status,
-                                 deleted=deleted,
-                                 id=slide_id))
+    body = (tablerow(slide,
+                     pathologysite,
+                     user,
+                     Date(created_datetime),
+                     clinical_details,
+                     status,
+                     deleted=deleted,
+                     id=slide_id) for slide_id, slide, user, pathologysite, created_datetime, status, deleted, clinical_details in paging.rows())
     
     actions = ({"name": _("View"), "href": url_for(".auth_slide", slide_id=0)},
                {"name": _("Edit"), "href": url_for(".edit_slide", slide_id=0)},
                {"name": _("Delete"), "href": url_for(".edit_slide", slide_id=0), "class": "!deleted", "method": "POST"},
                {"name": _("Restore"), "href": url_for(".edit_slide", slide_id=0), "class": "deleted", "method": "POST"},
                {"name": _("Log"), "href": url_for(".view_log", slide_id=0)})
-    return render_page("table.html",
-                       table={"head": head, "body": body, "actions": actions, "new": url_for(".new_slide")}, 
+    return stream_page("table.html",
+                       table={"head": head, "body": body, "actions": actions, "new": url_for(".new_slide"), "paging": paging}, 
                        title=_("Slides"),
                        buttons=())
 
@@ -74,17 +79,13 @@ def auth_slide(slide_id):
     sql = """SELECT slide.name, slide.directory_name, slide.status
              FROM slide
              WHERE slide.id = %(slide_id)s AND slide.deleted = FALSE AND slide.status = 'Ready';"""
-    with Transaction() as trans:
-        with trans.cursor() as cur:
-            cur.execute(sql, {"users_id": session["id"], "slide_id": slide_id})
-            row = cur.fetchone()
-            if not row:
-                return redirect(url_for(".slide_list"))
-            name, directory_name, status = row
-        
-            sql = """INSERT INTO editrecord (tablename, row_id, action, users_id, ip_address)
-                    VALUES ('slide', %(row_id)s, 'Viewed', %(users_id)s, %(ip_address)s);"""
-            cur.execute(sql, {"row_id": slide_id, "users_id": session["id"], "ip_address": request.remote_addr})
+    with Cursor() as cur:
+        cur.execute(sql, {"users_id": session["id"], "slide_id": slide_id})
+        row = cur.fetchone()
+    if not row:
+        return redirect(url_for(".slide_list"))
+    name, directory_name, status = row
+    record_event("slide", slide_id, "Viewed")
     
     config = current_app.config
     private_key = config.get("TILES_CDN_PRIVATE_KEY") or abort(exceptions.NotImplemented)
@@ -92,12 +93,28 @@ def auth_slide(slide_id):
     if tiles_cdn_base_url.endswith("/"):
         tiles_cdn_base_url = tiles_cdn_base_url[:-1]
     
+    # The CloudFront cookies are set on the cdn domain and so cannot be
+    # seen here, therefore a marker cookie records which cdn and key they
+    # were signed for and when they expire. While it is valid the set
+    # cookies round trip is skipped. A forged marker can only stop that
+    # browser from loading tiles.
     wildcard_url = build_url(tiles_cdn_base_url, "*")
-    cookies = cloudfront_sign_cookies(wildcard_url, private_key)
+    scope = f"{zlib.crc32(wildcard_url.encode()):x}.{private_key}"
+    marker_scope, _sep, marker_expires = request.cookies.get(TILES_MARKER_COOKIE, "").rpartition(":")
     destination = url_for(".view_slide", slide_id=slide_id, _external=True)
+    if marker_scope == scope and marker_expires.isdigit() and int(marker_expires) > time.time() + TILES_MARKER_MARGIN:
+        return redirect(destination)
     
+    cookies, expires = cloudfront_cached_cookies(wildcard_url, private_key)
     set_cookies_url = build_url(tiles_cdn_base_url, "set_cookies.html", cookies=cookies, destination=destination)
-    return redirect(cloudfront_sign_url(set_cookies_url, private_key))
+    response = redirect(cloudfront_sign_url(set_cookies_url, private_key))
+    response.set_cookie(TILES_MARKER_COOKIE,
+                        f"{scope}:{expires}",
+                        expires=expires,
+                        secure=request.is_secure,
+                        httponly=True,
+                        samesite="Lax")
+    return response
 
 
     
@@ -124,7 +141,7 @@ def view_slide(slide_id):
 
 
 
-@app.route("/slides/<int:slide_id>/edit", methods=["GET", "POST"])
+@app.route("/slides/<int:slide_id>/edit", methods=["GET", "POST"], retries=3)
 def edit_slide(slide_id):
     with Transaction() as trans:
         with trans.cursor() as cur:
@@ -305,11 +322,11 @@ def new_slide():
 
 
 
-@app.route("/slides/callback/<string:token>", max_age=60*60)
+@app.route("/slides/callback/<string:token>", max_age=60*60, retries=3)
 def deepzoom_callback(token):
     with Transaction() as trans:
         with trans.cursor() as cur:
-            quality = token.pop("quality", "Default")
+            quality = token.get("quality", "Default")
             sql = """UPDATE slide SET status = %(new_status)s
                     WHERE id = %(slide_id)s AND status = %(old_status)s;"""
             cur.execute(sql, token)
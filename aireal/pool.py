@@ -0,0 +1,387 @@
+import os
+import time
+import threading
+import pdb
+
+import psycopg2
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError
+
+from flask import current_app, g
+from werkzeug import exceptions
+
+__all__ = ["ConnectionPool",
+           "PooledConnection",
+           "pool_init",
+           "checkout",
+           "checkin"]
+
+
+
+class PooledConnection(connection):
+    """ psycopg2 connection that tracks its own session state so that
+        set_session is only called when the characteristics actually change
+        and rollback only when a transaction is actually open. The number
+        of calls made and avoided are counted in self.counters.
+
+        Writes may be deferred until commit with defer(), which buffers row
+        for flush(cursor, rows). Each flush function is then called once,
+        immediately before the transaction commits, with every row deferred
+        to it. Callbacks registered with after_commit() are called once the
+        transaction has committed. Both are discarded on rollback.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.characteristics = None
+        self.in_use = False
+        self.checkout_time = None
+        self.created_time = time.monotonic()
+        self.released_time = self.created_time
+        self.counters = dict.fromkeys(("set_session", "set_session_skipped", "rollback", "rollback_skipped"), 0)
+        self.deferred = {}
+        self.callbacks = []
+
+    def defer(self, flush, row):
+        self.deferred.setdefault(flush, []).append(row)
+
+    def after_commit(self, callback):
+        self.callbacks.append(callback)
+
+    def commit(self):
+        deferred, self.deferred = self.deferred, {}
+        if deferred:
+            with self.cursor() as cur:
+                for flush, rows in deferred.items():
+                    flush(cur, rows)
+        super().commit()
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self.deferred = {}
+        self.callbacks = []
+        super().rollback()
+
+    def configure(self, isolation_level, readonly):
+        characteristics = (isolation_level, readonly)
+        if characteristics != self.characteristics:
+            self.set_session(isolation_level=isolation_level, readonly=readonly)
+            self.characteristics = characteristics
+            self.counters["set_session"] += 1
+        else:
+            self.counters["set_session_skipped"] += 1
+
+    def reset(self):
+        """ Rollback any open transaction. Returns False if the connection
+            is broken and must be discarded.
+        """
+        self.deferred = {}
+        self.callbacks = []
+        if self.closed:
+            return False
+        status = self.info.transaction_status
+        if status == TRANSACTION_STATUS_IDLE:
+            self.counters["rollback_skipped"] += 1
+            return True
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return False
+        self.counters["rollback"] += 1
+        return True
+
+
+
+class ConnectionPool(object):
+    """ Thread safe pool of psycopg2 connections.
+
+    Drop in replacement for psycopg2.pool.ThreadedConnectionPool except
+    that getconn blocks for up to timeout seconds when all maxconn
+    connections are checked out rather than immediately raising
+    PoolError. Counters of checkout wait, hold time and occupancy are
+    maintained and returned by stats().
+
+    Connections above minconn that have been idle for more than
+    idle_timeout seconds are closed, as is any connection older than
+    max_lifetime seconds. A connection that has been idle for more than
+    health_check seconds is tested before it is handed out and silently
+    replaced if it is broken, eg following a database failover. None
+    disables each of these.
+    """
+    def __init__(self, minconn, maxconn, dsn, timeout=30.0, idle_timeout=None, max_lifetime=None, health_check=None):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.closed = False
+
+        self._idle = []
+        self._size = 0 # Connections open or in the process of being opened
+        self._cond = threading.Condition()
+        self._metrics = {"checkouts": 0,
+                         "timeouts": 0,
+                         "recycled": 0,
+                         "reaped": 0,
+                         "set_session": 0,
+                         "set_session_skipped": 0,
+                         "rollback": 0,
+                         "rollback_skipped": 0,
+                         "waiting": 0,
+                         "peak_in_use": 0,
+                         "wait_seconds": 0.0,
+                         "max_wait_seconds": 0.0,
+                         "hold_seconds": 0.0,
+                         "max_hold_seconds": 0.0}
+
+        for i in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+
+
+    def _expired(self, conn, now):
+        return self.max_lifetime is not None and now - conn.created_time > self.max_lifetime
+
+
+    def _reap(self, now):
+        # Must be called with the lock held. The idle list is used as a
+        # stack therefore the connections idle the longest are at the bottom.
+        while self.idle_timeout is not None and self._idle and self._size > self.minconn and \
+              now - self._idle[0].released_time > self.idle_timeout:
+            self._idle.pop(0).close()
+            self._size -= 1
+            self._metrics["reaped"] += 1
+
+
+    def _healthy(self, conn, now):
+        if conn.closed:
+            return False
+        if self.health_check is None or now - conn.released_time < self.health_check:
+            return True
+        try:
+            # Autocommit is a client side setting so this is a single
+            # round trip that leaves no transaction open.
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.autocommit = False
+        except psycopg2.Error:
+            return False
+        return True
+
+
+    def _discard(self, conn):
+        if not conn.closed:
+            conn.close()
+        with self._cond:
+            self._size -= 1
+            self._metrics["recycled"] += 1
+            self._cond.notify()
+
+
+    def getconn(self, timeout=None):
+        """ Check out a connection, waiting up to timeout seconds (default
+            self.timeout) for one to become available if the pool is
+            exhausted. Raises PoolError if none becomes available in time.
+            Expired or broken idle connections are replaced transparently.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        metrics = self._metrics
+
+        while True:
+            with self._cond:
+                if self.closed:
+                    raise PoolError("connection pool is closed")
+
+                metrics["waiting"] += 1
+                try:
+                    while not self._idle and self._size >= self.maxconn:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            metrics["timeouts"] += 1
+                            raise PoolError("connection pool exhausted")
+                        self._cond.wait(remaining)
+                finally:
+                    metrics["waiting"] -= 1
+
+                now = time.monotonic()
+                self._reap(now)
+                conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    # Reserve the slot now but connect outside of the lock.
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                break
+
+            if not self._expired(conn, now) and self._healthy(conn, now):
+                break
+            self._discard(conn)
+
+        now = time.monotonic()
+        waited = now - start
+        conn.checkout_time = now
+        with self._cond:
+            metrics["checkouts"] += 1
+            metrics["wait_seconds"] += waited
+            metrics["max_wait_seconds"] = max(metrics["max_wait_seconds"], waited)
+            metrics["peak_in_use"] = max(metrics["peak_in_use"], self._size - len(self._idle))
+        return conn
+
+
+    def putconn(self, conn, close=False):
+        """ Return a connection to the pool. Any open transaction is rolled
+            back and broken connections are discarded.
+        """
+        now = time.monotonic()
+        held = now - (conn.checkout_time or now)
+        conn.checkout_time = None
+        conn.released_time = now
+        close = close or self._expired(conn, now)
+
+        if not (close or conn.reset()):
+            close = True
+        if close and not conn.closed:
+            conn.close()
+
+        with self._cond:
+            metrics = self._metrics
+            metrics["hold_seconds"] += held
+            metrics["max_hold_seconds"] = max(metrics["max_hold_seconds"], held)
+            for key, val in conn.counters.items():
+                metrics[key] += val
+                conn.counters[key] = 0
+            if conn.closed or self.closed:
+                self._size -= 1
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._idle.append(conn)
+            self._reap(now)
+            self._cond.notify()
+
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+
+    def stats(self):
+        """ Returns a dict of the current pool occupancy and the cumulative
+            checkout counters.
+        """
+        with self._cond:
+            return {"size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "maxconn": self.maxconn,
+                    **self._metrics}
+
+
+
+def pool_init(app):
+    """ Create the application connection pool and arrange for the request
+        scoped connection to be returned to it when the application context
+        is torn down.
+
+        The pool is configured with the following optional keys:
+            DB_POOL_MIN: Connections kept open even when idle (1).
+            DB_POOL_MAX: Maximum connections. Every WSGI thread holds its
+                request connection and needs a second for the duration of
+                any Transaction or Cursor nested within another, see
+                checkout, therefore defaults to two per thread, as
+                advertised by waitress_serve, or 10 if the thread count is
+                unknown. If set explicitly it should be at least twice the
+                number of threads otherwise requests with nested blocks
+                may wait for, and time out waiting for, a connection.
+            DB_POOL_TIMEOUT: Seconds to wait for a free connection (30).
+            DB_POOL_IDLE_TIMEOUT: Seconds after which idle connections above
+                the minimum are closed (300).
+            DB_POOL_MAX_LIFETIME: Seconds after which a connection is
+                replaced (3600).
+            DB_POOL_HEALTH_CHECK: Idle seconds after which a connection is
+                tested before use (30).
+    """
+    config = app.config
+    threads = os.environ.get("AIREAL_WSGI_THREADS")
+    maxconn = config.get("DB_POOL_MAX") or (2 * int(threads) if threads else 10)
+    pool = ConnectionPool(config.get("DB_POOL_MIN", 1),
+                          maxconn,
+                          dsn=config["DB_URI"],
+                          timeout=config.get("DB_POOL_TIMEOUT", 30.0),
+                          idle_timeout=config.get("DB_POOL_IDLE_TIMEOUT", 300),
+                          max_lifetime=config.get("DB_POOL_MAX_LIFETIME", 60*60),
+                          health_check=config.get("DB_POOL_HEALTH_CHECK", 30))
+    app.extensions["connction_pool"] = pool
+
+    @app.teardown_appcontext
+    def release_connection(exc):
+        conn = g.pop("_connection", None)
+        if conn is not None:
+            pool.putconn(conn)
+
+
+
+def checkout(isolation_level, readonly):
+    """ Return a pooled connection with the requested session
+        characteristics.
+
+        Every Transaction and Cursor within a request shares a single
+        pooled connection which is held until the end of the request. If
+        that connection is already in use, ie a Transaction or Cursor is
+        opened inside another, then a second connection is checked out for
+        the duration of the inner block only.
+    """
+    pool = current_app.extensions["connction_pool"]
+    try:
+        conn = g.get("_connection")
+        if conn is None:
+            conn = g._connection = pool.getconn()
+        elif conn.in_use:
+            conn = pool.getconn()
+    except PoolError:
+        raise exceptions.ServiceUnavailable()
+
+    conn.in_use = True
+    conn.configure(isolation_level, readonly)
+    return conn
+
+
+
+def checkin(conn):
+    """ Rollback and release a connection obtained from checkout. The
+        request connection remains attached to the request unless it is
+        broken, any other is returned to the pool.
+    """
+    conn.in_use = False
+    if not conn.reset() and not conn.closed:
+        conn.close()
+
+    if conn.closed or conn is not g.get("_connection"):
+        if conn is g.get("_connection"):
+            g.pop("_connection")
+        current_app.extensions["connction_pool"].putconn(conn)
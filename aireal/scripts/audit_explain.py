@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import aireal
+import sys
+import pdb
+import psycopg2
+from flask import Flask
+
+from aireal.paging import Paginator
+
+
+
+LOG_TABLE_SQL = """SELECT users.name, editrecord.action, editrecord.details, editrecord.edit_datetime
+                   FROM editrecord
+                   LEFT OUTER JOIN users ON editrecord.users_id = users.id
+                   WHERE editrecord.tablename = %(table)s AND editrecord.row_id = %(row_id)s
+                   ORDER BY editrecord.edit_datetime, editrecord.id;"""
+
+AUDIT_VIEW_SQL = """SELECT audittrail.id, audittrail.action, audittrail.name, audittrail.keyvals, audittrail.format_string, audittrail.datetime, users.name AS username
+                    FROM audittrail
+                    JOIN users ON audittrail.users_id = users.id
+                    JOIN auditlink ON auditlink.audittrail_id = audittrail.id
+                    WHERE auditlink.tablename = %(tablename)s AND auditlink.row_id = %(row_id)s"""
+
+
+
+def audit_view_query(tablename, row_id):
+    """ The first page query of generic_views.audit_view, built by its
+        Paginator.
+    """
+    with Flask(__name__).test_request_context():
+        paging = Paginator(AUDIT_VIEW_SQL, {"tablename": tablename, "row_id": row_id},
+                           columns=("name", "action", None, "username", "datetime"),
+                           searchable=("name", "action", "username"),
+                           default="datetime")
+        return paging._query()
+
+
+
+def plan_nodes(node):
+    """ Generator of every node of a json explain plan.
+    """
+    yield node
+    for child in node.get("Plans", ()):
+        yield from plan_nodes(child)
+
+
+
+def seed(cur, n, tablename, row_id):
+    """ Insert n synthetic editrecord rows and n audittrail rows, each with
+        an auditlink, spread over 50 tables of 10000 rows, plus 20 of each
+        for the row looked up, so that its history is a small fraction of
+        the table.
+    """
+    cur.execute("SELECT id FROM users ORDER BY id LIMIT 1;")
+    users = cur.fetchone()
+    if users is None:
+        sys.exit("Seeding requires at least one user")
+
+    sql = """INSERT INTO editrecord (tablename, row_id, action, details, users_id, edit_datetime)
+             SELECT 'table' || (i %% 50), i %% 10000, 'Edited', '{}'::jsonb, %(users_id)s, current_timestamp - i * interval '1 second'
+             FROM generate_series(1, %(n)s) AS i
+             UNION ALL
+             SELECT %(tablename)s, %(row_id)s, 'Edited', '{}'::jsonb, %(users_id)s, current_timestamp - i * interval '1 minute'
+             FROM generate_series(1, 20) AS i;"""
+    cur.execute(sql, {"n": n, "tablename": tablename, "row_id": row_id, "users_id": users[0]})
+
+    cur.execute("INSERT INTO auditaction (name) VALUES ('Edited') ON CONFLICT DO NOTHING;")
+    cur.execute("INSERT INTO audittarget (name) VALUES ('AuditExplain') ON CONFLICT DO NOTHING;")
+    sql = """WITH trail AS (
+                 INSERT INTO audittrail (action, target, name, users_id, datetime)
+                 SELECT 'Edited', 'AuditExplain', 'Row ' || i, %(users_id)s, current_timestamp - i * interval '1 second'
+                 FROM generate_series(1, %(n)s + 20) AS i
+                 RETURNING id, name
+                 )
+             INSERT INTO auditlink (audittrail_id, tablename, row_id)
+             SELECT id,
+                    CASE WHEN n <= 20 THEN %(tablename)s ELSE 'table' || (n %% 50) END,
+                    CASE WHEN n <= 20 THEN %(row_id)s ELSE n %% 10000 END
+             FROM (SELECT id, row_number() OVER (ORDER BY id) AS n FROM trail) AS numbered;"""
+    cur.execute(sql, {"n": n, "tablename": tablename, "row_id": row_id, "users_id": users[0]})
+    cur.execute("ANALYZE editrecord, audittrail, auditlink;")
+
+
+
+def main():
+    """ Check that the history lookups by (tablename, row_id) are served by
+        indexes within a latency budget. These are the editrecord lookup of
+        view_helpers.log_table, which must use ix_editrecord_tablename_row_id,
+        and the auditlink lookup of generic_views.audit_view, which must use
+        pk_auditlink and then fetch audittrail rows by pk_audittrail.
+        Optionally seeds the tables with synthetic rows first, all within a
+        transaction that is rolled back so the database is left unchanged.
+        Exits non-zero if a plan does not use its indexes or a query is too
+        slow, so it can be run against a staging database after each
+        migration.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("instance_path", help="Path to instance folder containing the config file with database connection uri.")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Number of synthetic editrecord and audittrail rows to insert before explaining.")
+    parser.add_argument("-t", "--table", default="samples", help="Tablename to look up.")
+    parser.add_argument("-r", "--row-id", type=int, default=1, help="Row id to look up.")
+    parser.add_argument("-b", "--budget", type=float, default=5.0, help="Maximum execution time of each query in milliseconds.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print the plans.")
+    args = parser.parse_args()
+
+    config = aireal.load_config(aireal.config_file(args.instance_path))
+    if "DB_URI" not in config:
+        sys.exit("No DB_URI within config file")
+
+    checks = (("log_table", LOG_TABLE_SQL, {"table": args.table, "row_id": args.row_id}, ("ix_editrecord_tablename_row_id",)),
+              ("audit_view", *audit_view_query(args.table, args.row_id), ("pk_auditlink", "pk_audittrail")))
+
+    conn = psycopg2.connect(config["DB_URI"])
+    plans = {}
+    try:
+        with conn.cursor() as cur:
+            if args.seed:
+                seed(cur, args.seed, args.table, args.row_id)
+            for name, sql, params, indexes in checks:
+                cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, params)
+                explain = cur.fetchone()[0]
+                plans[name] = (json.loads(explain) if isinstance(explain, str) else explain)[0]
+    finally:
+        conn.rollback()
+        conn.close()
+
+    errors = []
+    for name, sql, params, indexes in checks:
+        plan = plans[name]
+        if args.verbose:
+            print(json.dumps(plan, indent=2), file=sys.stderr)
+        used = {node.get("Index Name") for node in plan_nodes(plan["Plan"])}
+        for index in indexes:
+            if index not in used:
+                errors.append(f"{name} plan does not use {index}")
+        if plan["Execution Time"] > args.budget:
+            errors.append(f"{name} execution time {plan['Execution Time']:.3f}ms exceeds budget of {args.budget}ms")
+        print(f"{name}: {', '.join(sorted(filter(None, used)))} used, {plan['Execution Time']:.3f}ms", file=sys.stderr)
+    if errors:
+        sys.exit("\n".join(errors))
+    print("OK", file=sys.stderr)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pdb
+
+import boto3
+from botocore.config import Config
+
+import aireal.aws
+from aireal.aws import list_objects, s3_sign_url
+
+try:
+    from moto import mock_aws
+except ImportError:
+    try:
+        from moto import mock_s3 as mock_aws
+    except ImportError:
+        mock_aws = None
+
+
+
+def new_client(service, region_name=None, **config):
+    """ A new client on every call, as the aws helpers did before the
+        client registry.
+    """
+    return boto3.client(service, region_name=region_name, config=Config(**config) if config else None)
+
+
+
+def upload_request(bucket, directory, n, accelerate):
+    """ The s3 calls made by new_slide for one file of a directory upload,
+        checking for an earlier upload of the directory and of the file
+        and then signing the upload url. S3 Accelerate, as used by
+        s3_sign_url, cannot be combined with a custom endpoint so without
+        accelerate the url is signed with the plain s3 client instead.
+    """
+    prefix = f"slides/1/{directory}/"
+    list_objects(bucket, prefix)
+    upload_key = f"{prefix}1650000000000/r{n}c0.jpg"
+    list_objects(bucket, upload_key)
+    if accelerate:
+        return s3_sign_url(bucket, upload_key, hours=1)
+    return aireal.aws.boto3_client("s3").generate_presigned_url(ClientMethod="put_object",
+                                                                ExpiresIn=60*60,
+                                                                Params={"Bucket": bucket, "Key": upload_key})
+
+
+
+def bench(bucket, requests, threads, repeats, accelerate=True):
+    """ Time upload_request with a new client per call and with the client
+        registry. Returns a dict of mode to the best mean latency and
+        throughput.
+    """
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket=bucket)
+    for i in range(20):
+        s3.put_object(Bucket=bucket, Key=f"slides/1/existing/1650000000000/r{i}c0.jpg", Body=b"")
+
+    registry = aireal.aws.boto3_client
+    results = {}
+    for repeat in range(repeats):
+        for mode, client in (("before", new_client), ("after", registry)):
+            aireal.aws.boto3_client = client
+            try:
+                def timed(n):
+                    start = time.perf_counter()
+                    upload_request(bucket, "existing" if n % 2 else "new", n, accelerate)
+                    return time.perf_counter() - start
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(threads) as executor:
+                    latencies = list(executor.map(timed, range(requests)))
+                elapsed = time.perf_counter() - start
+            finally:
+                aireal.aws.boto3_client = registry
+
+            mean = sum(latencies) / len(latencies)
+            best = results.get(mode)
+            if best is None or mean < best[0]:
+                results[mode] = (mean, requests / elapsed)
+    return results
+
+
+
+def main():
+    """ Measure the latency of the s3 calls made by each new_slide request
+        with a new boto3 client built for every call, as before, and with
+        the shared client registry. Runs against an in memory S3 provided
+        by moto by default or an S3 compatible endpoint such as MinIO if
+        given, whose latency then dominates less of the measurement.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=200, help="Number of new_slide requests.")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of requests made simultaneously, eg waitress threads.")
+    parser.add_argument("-k", "--repeats", type=int, default=3, help="Number of times each measurement is repeated, the best is reported.")
+    parser.add_argument("-e", "--endpoint-url", help="S3 compatible endpoint, eg a local MinIO server, rather than moto.", default=None)
+    parser.add_argument("-b", "--bucket", help="Bucket to use, created if needed.", default="aireal-bench")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    if args.endpoint_url is not None:
+        # Picked up by every client, including those built by the registry.
+        os.environ["AWS_ENDPOINT_URL"] = args.endpoint_url
+        results = bench(args.bucket, args.requests, args.threads, args.repeats, accelerate=False)
+
+    elif mock_aws is None:
+        sys.exit("moto is not installed, install it or give the --endpoint-url of an S3 compatible server")
+
+    else:
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        with mock_aws():
+            results = bench(args.bucket, args.requests, args.threads, args.repeats)
+
+    print(f"{'mode':<10}{'ms/request':>12}{'requests/s':>12}")
+    for mode, (mean, throughput) in results.items():
+        print(f"{mode:<10}{mean * 1000:>12.2f}{throughput:>12.1f}")
+
+
+
+if __name__ == "__main__":
+    main()
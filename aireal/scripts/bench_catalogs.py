@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+import pdb
+
+from babel.messages.pofile import read_po
+from flask import Flask, current_app, session
+
+import aireal
+from aireal.i18n import _, _load_catalog
+
+
+
+def po_files():
+    """ Dict of locale to .po file of every catalog in the package.
+    """
+    locales_dir = os.path.join(os.path.dirname(aireal.__file__), "locales")
+    paths = {}
+    for locale in os.listdir(locales_dir):
+        po_file = os.path.join(locales_dir, locale, "LC_MESSAGES", f"{locale}.po")
+        if os.path.exists(po_file):
+            paths[locale] = po_file
+    return paths
+
+
+
+def parse_catalogs(paths):
+    """ Load every catalog as i18n_init did before caching, ie parsing
+        each .po file with babel.
+    """
+    translations = {}
+    for locale, po_file in paths.items():
+        with open(po_file, encoding="utf-8-sig") as f:
+            catalog = read_po(f)
+        translations[locale] = {message.id: message.string for message in catalog if message.id and message.string}
+    return translations
+
+
+
+def cached_catalogs(paths, cache_dir):
+    return {locale: _load_catalog(po_file, os.path.join(cache_dir, f"{locale}.pickle")) for locale, po_file in paths.items()}
+
+
+
+def exception_lookup(text):
+    """ _ as it was before, raising and catching KeyError on every miss.
+    """
+    try:
+        return current_app.extensions["locales"][session["locale"]][text]
+    except KeyError:
+        return text
+
+
+
+def best_of(repeats, function, *args):
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+
+def main():
+    """ Measure the time taken to load the message catalogs at startup,
+        parsing every .po file as before and from the pickled cache, and
+        the number of _() calls per second within a request, for both
+        translated messages and the English fallback that always misses,
+        before and after. Needs no database.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=200000, help="Number of _() calls per measurement.")
+    parser.add_argument("-k", "--repeats", type=int, default=5, help="Number of times each measurement is repeated, the best is reported.")
+    args = parser.parse_args()
+
+    paths = po_files()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        parsing = best_of(args.repeats, parse_catalogs, paths)
+        start = time.perf_counter()
+        translations = cached_catalogs(paths, cache_dir)
+        cold = time.perf_counter() - start
+        warm = best_of(args.repeats, cached_catalogs, paths, cache_dir)
+    if translations != parse_catalogs(paths):
+        raise RuntimeError("Cached catalogs differ from the parsed catalogs")
+
+    print(f"Loading {len(paths)} catalogs, {sum(map(len, translations.values()))} messages")
+    print(f"{'mode':<26}{'ms':>10}")
+    print(f"{'before, parse .po':<26}{parsing * 1000:>10.2f}")
+    print(f"{'after, first start':<26}{cold * 1000:>10.2f}")
+    print(f"{'after, cached':<26}{warm * 1000:>10.2f}")
+
+    app = Flask(__name__)
+    app.secret_key = "bench"
+    app.extensions["locales"] = dict(translations, en_GB={})
+    locale, catalog = next(((locale, catalog) for locale, catalog in translations.items() if catalog), (None, {}))
+    hit = next(iter(catalog), None)
+
+    print(f"\n_() calls per second")
+    print(f"{'mode':<10}{'locale':<10}{'message':<12}{'calls/s':>12}")
+    for session_locale, text, kind in (("en_GB", "Users", "fallback"), (locale, hit, "translated")):
+        if text is None:
+            continue
+        with app.test_request_context():
+            session["locale"] = session_locale
+            for mode, lookup in (("before", exception_lookup), ("after", _)):
+                elapsed = best_of(args.repeats, lambda: [lookup(text) for i in range(args.number)])
+                print(f"{mode:<10}{session_locale:<10}{kind:<12}{args.number / elapsed:>12.0f}")
+
+
+
+if __name__ == "__main__":
+    main()
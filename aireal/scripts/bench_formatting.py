@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+import pdb
+
+from pytz import timezone as pytz_timezone
+from babel.core import Locale
+from babel.dates import format_datetime
+from babel.numbers import parse_pattern, format_percent
+from babel.units import _find_unit_pattern
+from flask import Flask, session
+
+from aireal.i18n import Date, Number, Percent, format_rows
+
+
+
+def uncached_decimal(value, locale):
+    babel_locale = Locale.parse(locale)
+    pattern = parse_pattern(babel_locale.decimal_formats.get(None))
+    return pattern.apply(value, babel_locale)
+
+
+
+def uncached_unit(value, measurement_unit, locale, length="short"):
+    babel_locale = Locale.parse(locale)
+    q_unit = _find_unit_pattern(measurement_unit, locale=babel_locale)
+    unit_patterns = babel_locale._data["unit_patterns"][q_unit].get(length, {})
+    if isinstance(value, str):
+        return unit_patterns["one"].format(value)
+    return unit_patterns[babel_locale.plural_form(value)].format(uncached_decimal(value, locale))
+
+
+
+def uncached_html(cell):
+    """ Render a Date, Number or Percent as their __html__ methods did
+        before caching, parsing the locale, pattern, unit and timezone for
+        every cell.
+    """
+    if cell.val is None:
+        return ""
+    locale = session["locale"]
+    if isinstance(cell, Date):
+        tz = pytz_timezone(session["timezone"])
+        dt = cell.val.astimezone(tz)
+        ret = format_datetime(dt, format=cell.format, locale=locale)
+        if cell.format != "long":
+            ret = "{} {}".format(ret, dt.strftime("%Z"))
+        return ret
+    if isinstance(cell, Percent):
+        return format_percent(cell.val, locale=locale, decimal_quantization=False)
+    if cell.units is not None:
+        return uncached_unit(cell.val, cell.units, locale)
+    return uncached_decimal(cell.val, locale)
+
+
+
+def synthetic_table(cells):
+    """ Table body of tablerow style rows, like the BaseSpace datasets
+        table, with cells//5 rows of five formatted cells each.
+    """
+    rng = random.Random(0)
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    body = []
+    for i in range(cells // 5):
+        body.append(((f"Sample{i}",
+                      Number(rng.randint(0, 10**7)),
+                      Number(rng.random() * 100, frac_prec=2, units="digital-gigabyte"),
+                      Percent(rng.random(), frac_prec=2),
+                      Date(start + timedelta(minutes=rng.randint(0, 10**6))),
+                      Number(None)),
+                     {"id": i}))
+    return body
+
+
+
+def main():
+    """ Format every cell of a synthetic table of Dates, Numbers, Percents
+        and Numbers with units, as before with the locale, patterns and
+        timezone parsed for every cell, cell by cell through the cached
+        formatters and in bulk with format_rows as render_page does. Needs
+        no database.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cells", type=int, default=10000, help="Number of formatted cells in the table.")
+    parser.add_argument("-k", "--repeats", type=int, default=3, help="Number of times each measurement is repeated, the best is reported.")
+    parser.add_argument("-l", "--locales", nargs="+", default=["en_GB", "fr"], help="Locales to format in.")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.secret_key = "bench"
+    body = synthetic_table(args.cells)
+    n_cells = sum(1 for cells, attr in body for cell in cells[1:])
+
+    modes = (("before", lambda: [[uncached_html(cell) for cell in cells[1:]] for cells, attr in body]),
+             ("per cell", lambda: [[cell.__html__() for cell in cells[1:]] for cells, attr in body]),
+             ("format_rows", lambda: list(format_rows(body))))
+
+    print(f"{n_cells} cells")
+    print(f"{'locale':<10}{'mode':<14}{'ms':>10}{'us/cell':>10}")
+    for locale in args.locales:
+        with app.test_request_context():
+            session["locale"] = locale
+            session["timezone"] = "Europe/London"
+            results = {}
+            for mode, function in modes:
+                timings = []
+                for i in range(args.repeats):
+                    start = time.perf_counter()
+                    results[mode] = function()
+                    timings.append(time.perf_counter() - start)
+                elapsed = min(timings)
+                print(f"{locale:<10}{mode:<14}{elapsed * 1000:>10.1f}{elapsed * 1e6 / n_cells:>10.2f}")
+
+            bulk = [[str(cell) for cell in cells[1:]] for cells, attr in results["format_rows"]]
+            if not results["before"] == results["per cell"] == bulk:
+                raise RuntimeError(f"Formatting differs from before in {locale}")
+
+
+
+if __name__ == "__main__":
+    main()
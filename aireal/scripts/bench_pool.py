@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+import pdb
+
+import aireal
+from aireal.pool import PooledConnection
+from psycopg2.extensions import parse_dsn, make_dsn
+
+
+
+SSL_REQUEST = 80877103
+GSSENC_REQUEST = 80877104
+CANCEL_REQUEST = 80877102
+
+DEFAULT_URLS = ("/users", "/projects", "/locations", "/locationmodels", "/pathologysites")
+
+
+
+class QueryCounter(object):
+    """ Local tcp proxy in front of PostgreSQL that counts the simple query
+        messages sent by clients, each of which is one round trip to the
+        server. psycopg2 only uses the simple query protocol, so this counts
+        every BEGIN, SET, statement, COMMIT and ROLLBACK actually sent, as
+        opposed to the calls made in python which psycopg2 may answer
+        without contacting the server. Connections must not use ssl.
+    """
+    def __init__(self, host, port):
+        self.target = (host, port)
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._listener = socket.socket()
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen()
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, address = self._listener.accept()
+            server = socket.create_connection(self.target)
+            threading.Thread(target=self._forward, args=(server, client, False), daemon=True).start()
+            threading.Thread(target=self._forward, args=(client, server, True), daemon=True).start()
+
+    def _forward(self, source, destination, count):
+        buf = b""
+        startup = True
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+                if not count:
+                    continue
+                buf += data
+                while True:
+                    if startup:
+                        # Startup and negotiation messages have no type byte.
+                        if len(buf) < 8:
+                            break
+                        length, code = struct.unpack("!ii", buf[:8])
+                        if len(buf) < length:
+                            break
+                        buf = buf[length:]
+                        if code not in (SSL_REQUEST, GSSENC_REQUEST, CANCEL_REQUEST):
+                            startup = False
+                    else:
+                        if len(buf) < 5:
+                            break
+                        length = struct.unpack("!i", buf[1:5])[0]
+                        if len(buf) < length + 1:
+                            break
+                        if buf[:1] == b"Q":
+                            with self._lock:
+                                self.queries += 1
+                        buf = buf[length + 1:]
+        except OSError:
+            pass
+        finally:
+            source.close()
+            destination.close()
+
+
+
+def unconditional(enabled):
+    """ Restore the behaviour before session state was tracked, ie
+        set_session on every checkout and rollback on every checkin, if
+        enabled. Returns a function that undoes the change.
+    """
+    configure, reset = PooledConnection.configure, PooledConnection.reset
+    if enabled:
+        def always_configure(self, isolation_level, readonly):
+            self.characteristics = None
+            configure(self, isolation_level, readonly)
+
+        def always_reset(self):
+            if self.closed:
+                return False
+            self.rollback()
+            self.counters["rollback"] += 1
+            return True
+
+        PooledConnection.configure = always_configure
+        PooledConnection.reset = always_reset
+
+    def undo():
+        PooledConnection.configure, PooledConnection.reset = configure, reset
+    return undo
+
+
+
+def main():
+    """ Render table views repeatedly and report, per request, the number
+        of set_session and rollback calls made and the number of round
+        trips actually sent to the server, with and without the tracking
+        of session state in PooledConnection. Round trips are counted by a
+        proxy placed between the connection pool and the database. Uses
+        the database configured in instance_path and does not modify it.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("instance_path", help="Path to instance folder containing the config file with database connection uri.")
+    parser.add_argument("-u", "--users-id", type=int, default=1, help="Id of the user to render the views as.")
+    parser.add_argument("-r", "--role", default="Admin", help="Role to render the views as.")
+    parser.add_argument("-n", "--requests", type=int, default=50, help="Number of requests per view.")
+    parser.add_argument("urls", nargs="*", default=DEFAULT_URLS, help="Table views to render.")
+    args = parser.parse_args()
+
+    app = aireal.create_app(args.instance_path)
+    pool = app.extensions["connction_pool"]
+    dsn = parse_dsn(app.config["DB_URI"])
+    counter = QueryCounter(dsn.get("host", "localhost"), int(dsn.get("port", 5432)))
+
+    # Replace the connections opened by create_app with ones through the proxy.
+    idle = [pool.getconn() for i in range(pool.stats()["idle"])]
+    for conn in idle:
+        pool.putconn(conn, close=True)
+    pool.dsn = make_dsn(app.config["DB_URI"], host="127.0.0.1", port=counter.port, sslmode="disable")
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update({"id": args.users_id, "role": args.role, "locale": "en_GB", "timezone": "UTC", "csrf": ""})
+
+    print(f"{'view':<24}{'mode':<10}{'round trips':>12}{'set_session':>12}{'rollback':>10}{'ms':>8}")
+    failed = False
+    for url in args.urls:
+        for mode in ("before", "after"):
+            undo = unconditional(mode == "before")
+            try:
+                client.get(url) # Warm up any per app caches
+                stats = pool.stats()
+                queries = counter.queries
+                start = time.perf_counter()
+                for i in range(args.requests):
+                    response = client.get(url)
+                    if response.status_code != 200:
+                        print(f"{url} returned {response.status_code}", file=sys.stderr)
+                        failed = True
+                        break
+                elapsed = time.perf_counter() - start
+            finally:
+                undo()
+            after = pool.stats()
+            n = args.requests
+            print(f"{url:<24}{mode:<10}"
+                  f"{(counter.queries - queries) / n:>12.1f}"
+                  f"{(after['set_session'] - stats['set_session']) / n:>12.1f}"
+                  f"{(after['rollback'] - stats['rollback']) / n:>10.1f}"
+                  f"{elapsed * 1000 / n:>8.2f}")
+    if failed:
+        sys.exit(1)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import time
+import pdb
+
+from flask import Flask, current_app
+from itsdangerous import URLSafeTimedSerializer
+
+import aireal.flask
+from aireal.flask import Blueprint, sign_token, _validate_token
+
+
+
+def uncached_serializer(salt):
+    """ The serializer as built before caching, ie on every call.
+    """
+    return URLSafeTimedSerializer(current_app.config["SECRET_KEY"], salt=salt)
+
+
+
+def callback_app(fallbacks):
+    """ Minimal app with a single token authenticated callback route.
+    """
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = os.urandom(16)
+    if fallbacks:
+        app.config["SECRET_KEY_FALLBACKS"] = [os.urandom(16) for i in range(fallbacks)]
+
+    bp = Blueprint("Bench", __name__)
+
+    @bp.route("/callback/<string:token>", signature="callback")
+    def callback(token):
+        return {"quality": token.get("quality")}
+
+    app.register_blueprint(bp)
+    return app
+
+
+
+def main():
+    """ Measure signing and verifying tokens, and the throughput of a token
+        authenticated callback route such as deepzoom_callback, with a new
+        serializer built on every call as before and with the cached
+        serializers. Needs no database.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=20000, help="Number of tokens to sign and verify.")
+    parser.add_argument("-r", "--requests", type=int, default=5000, help="Number of callback requests.")
+    parser.add_argument("-k", "--repeats", type=int, default=3, help="Number of times each measurement is repeated.")
+    parser.add_argument("-f", "--fallbacks", type=int, default=0, help="Number of old keys in SECRET_KEY_FALLBACKS.")
+    args = parser.parse_args()
+
+    app = callback_app(args.fallbacks)
+    cached_serializer = aireal.flask._serializer
+    client = app.test_client()
+    data = {"quality": "High", "slide_id": 1234}
+
+    # Modes are interleaved and the best of each repeat reported to reduce
+    # the effect of warm up and noise.
+    best = {}
+    for repeat in range(args.repeats):
+        for mode, serializer in (("before", uncached_serializer), ("after", cached_serializer)):
+            aireal.flask._serializer = serializer
+            try:
+                with app.app_context():
+                    start = time.perf_counter()
+                    tokens = [sign_token(data, salt="callback") for i in range(args.number)]
+                    signing = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    for token in tokens:
+                        if _validate_token(token, max_age=60, salt="callback") != data:
+                            raise RuntimeError("Token failed to verify")
+                    verifying = time.perf_counter() - start
+
+                url = f"/callback/{tokens[0]}"
+                client.get(url)
+                start = time.perf_counter()
+                for i in range(args.requests):
+                    response = client.get(url)
+                    if response.status_code != 200:
+                        raise RuntimeError(f"Callback returned {response.status_code}")
+                requesting = time.perf_counter() - start
+            finally:
+                aireal.flask._serializer = cached_serializer
+
+            timings = (signing, verifying, requesting)
+            best[mode] = tuple(map(min, zip(best.get(mode, timings), timings)))
+
+    print(f"{'mode':<10}{'sign us':>10}{'verify us':>12}{'callbacks/s':>14}")
+    for mode, (signing, verifying, requesting) in best.items():
+        print(f"{mode:<10}{signing * 1e6 / args.number:>10.1f}{verifying * 1e6 / args.number:>12.1f}{args.requests / requesting:>14.0f}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 
 import waitress
 import importlib
+import os
 import sys
 
 
@@ -17,6 +18,10 @@ def main():
     if len(keys) != len(values):
         raise RuntimeError("Missing argument value.")
 
+    # Allow the application to size its database connection pool to match.
+    kwargs = dict(zip(keys, values))
+    os.environ["AIREAL_WSGI_THREADS"] = kwargs.get("threads", "4")
+    
     colon_index = target.find(":")
     module_name = target[:colon_index]
     entry_point = target[colon_index+1:]
@@ -25,7 +30,7 @@ def main():
     module = importlib.import_module(module_name)
     app = eval(entry_point, vars(module))
     
-    waitress.serve(app, **dict(zip(keys, values)))
+    waitress.serve(app, **kwargs)
     
 
 
@@ -0,0 +1,234 @@
+import time
+import threading
+from secrets import token_urlsafe
+from collections import OrderedDict
+from datetime import timedelta
+import pdb
+
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+
+from flask.sessions import SessionInterface, SecureCookieSession, session_json_serializer
+
+from .pool import checkout, checkin
+
+__all__ = ["ServerSideSession",
+           "PostgresSessionInterface",
+           "sessions_init"]
+
+
+
+class ServerSideSession(SecureCookieSession):
+    """ Session whose contents are stored in the database and identified by
+        sid. Clearing the session, as is done on login and logout, causes
+        a new sid to be issued to prevent session fixation.
+    """
+    def __init__(self, initial=None, sid=None, expires=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires = expires
+        self.rotate = False
+
+    def clear(self):
+        super().clear()
+        self.rotate = True
+
+
+
+class _LocalCache(object):
+    """ Thread safe, size bounded LRU of sid -> (data, expires) whose
+        entries are only trusted for ttl seconds.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            try:
+                cached_at, value = self._entries[sid]
+            except KeyError:
+                return None
+            if time.monotonic() - cached_at > self.ttl:
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return value
+
+    def set(self, sid, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[sid] = (time.monotonic(), value)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+
+class PostgresSessionInterface(SessionInterface):
+    """ Server side sessions stored in the UNLOGGED websession table. The
+        cookie holds only a random session id, therefore nothing is signed
+        or serialised into the cookie on each request. The session contents
+        are serialised with the same tagged JSON serializer as the cookie
+        sessions, so all types that can be stored in a cookie session,
+        including the registered date tag, can be stored here.
+
+    Sessions expire ttl seconds after they were last written. The expiry is
+    only extended once it is half used so that a request that does not
+    modify the session normally performs no write. Sessions are read
+    through a local in process cache whose entries are trusted for
+    cache_ttl seconds. With more than one process serving the application
+    this is the time a logout in one may take to be seen by the others,
+    set cache_ttl to 0 to disable the cache if that is unacceptable.
+
+    Args:
+        ttl:
+            Lifetime of an unmodified session in seconds.
+        cache_size:
+            Maximum number of sessions held in the local cache.
+        cache_ttl:
+            Seconds that a cached session is trusted for.
+    """
+    serializer = session_json_serializer
+    session_class = ServerSideSession
+
+    def __init__(self, ttl, cache_size=1000, cache_ttl=60):
+        self.ttl = ttl
+        self.cache = _LocalCache(cache_size, cache_ttl)
+        self._purged = time.monotonic()
+
+
+    def _execute(self, sql, params):
+        conn = checkout(ISOLATION_LEVEL_READ_COMMITTED, readonly=False)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                row = cur.fetchone() if cur.description else None
+            conn.commit()
+        finally:
+            checkin(conn)
+        return row
+
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return self.session_class()
+
+        cached = self.cache.get(sid)
+        if cached is None:
+            sql = """SELECT data, extract(epoch FROM expires)
+                     FROM websession
+                     WHERE id = %(sid)s AND expires > current_timestamp;"""
+            row = self._execute(sql, {"sid": sid})
+            if row is None:
+                return self.session_class()
+            cached = (row[0], float(row[1]))
+            self.cache.set(sid, cached)
+
+        data, expires = cached
+        return self.session_class(self.serializer.loads(data), sid=sid, expires=expires)
+
+
+    def _store(self, session):
+        data = self.serializer.dumps(dict(session))
+        expires = time.time() + self.ttl
+        sql = """INSERT INTO websession (id, data, expires)
+                 VALUES (%(sid)s, %(data)s, to_timestamp(%(expires)s))
+                 ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, expires = EXCLUDED.expires;"""
+        self._execute(sql, {"sid": session.sid, "data": data, "expires": expires})
+        session.expires = expires
+        self.cache.set(session.sid, (data, expires))
+
+
+    def _delete(self, sid):
+        self.cache.pop(sid)
+        self._execute("DELETE FROM websession WHERE id = %(sid)s;", {"sid": sid})
+
+
+    def _purge(self):
+        # Expired sessions are removed at most once a minute per process.
+        now = time.monotonic()
+        if now - self._purged > 60:
+            self._purged = now
+            self._execute("DELETE FROM websession WHERE expires < current_timestamp;", {})
+
+
+    def dumps(self, app, data):
+        """ Store data as a new session and return the cookie value that
+            identifies it. Used by flask.flask_cookie.
+        """
+        session = self.session_class(data, sid=token_urlsafe(32))
+        self._store(session)
+        return session.sid
+
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if session.sid is not None and (session.rotate or not session):
+            self._delete(session.sid)
+            old_sid, session.sid = session.sid, None
+        else:
+            old_sid = None
+
+        if not session:
+            if old_sid is not None:
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+                response.vary.add("Cookie")
+            return
+
+        if session.sid is None:
+            session.sid = token_urlsafe(32)
+            self._store(session)
+            self._purge()
+        elif session.modified or session.expires - time.time() < self.ttl / 2:
+            self._store(session)
+        else:
+            return
+
+        response.set_cookie(name,
+                            session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=httponly,
+                            domain=domain,
+                            path=path,
+                            secure=secure,
+                            samesite=samesite)
+        response.vary.add("Cookie")
+
+
+
+def sessions_init(app):
+    """ Replace the signed cookie sessions with server side sessions if
+        enabled by the SERVER_SESSIONS config key. Further configured with
+        the following optional keys:
+            SESSION_TTL: Lifetime of an unmodified session in seconds
+                (PERMANENT_SESSION_LIFETIME).
+            SESSION_CACHE_SIZE: Sessions held in the local cache (1000).
+            SESSION_CACHE_TTL: Seconds a cached session is trusted (60).
+    """
+    config = app.config
+    if not config.get("SERVER_SESSIONS"):
+        return
+
+    ttl = config.get("SESSION_TTL") or config["PERMANENT_SESSION_LIFETIME"]
+    if isinstance(ttl, timedelta):
+        ttl = ttl.total_seconds()
+    app.session_interface = PostgresSessionInterface(ttl,
+                                                     cache_size=config.get("SESSION_CACHE_SIZE", 1000),
+                                                     cache_ttl=config.get("SESSION_CACHE_TTL", 60))
@@ -1,7 +1,10 @@
 import pdb
 from datetime import datetime, timezone
 import time
-from functools import wraps
+import random
+import threading
+from itertools import count
+from functools import wraps, partial
 from collections import defaultdict
 from ipaddress import ip_address, ip_network
 from urllib.parse import urlparse, urlunparse, parse_qs, unquote_plus, urlencode
@@ -21,10 +24,13 @@ from itsdangerous.exc import BadSignature
 from itsdangerous import URLSafeTimedSerializer
 
 from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError, encodings
 from psycopg2.extensions import ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
 
 from .i18n import _
 from .forms import ActionForm
+from .pool import checkout, checkin
+from .audit import audit_sink
 
 
 __all__ = ["utcnow",
@@ -39,7 +45,19 @@ __all__ = ["utcnow",
            "iso8601_to_utc",
            "demonise",
            "audit_log",
-           "keyvals_from_form"]
+           "write_audit_log",
+           "keyvals_from_form",
+           "retry_transaction",
+           "retry_stats",
+           "stream_rows"]
+
+
+
+# Serialization failure and deadlock detected.
+RETRYABLE_PGCODES = ("40001", "40P01")
+_retry_counts = defaultdict(lambda: {"attempts": 0, "retries": 0, "failures": 0})
+_retry_lock = threading.Lock()
+_cursor_names = count()
 
 
 
@@ -57,21 +75,20 @@ def dict_from_select(cur, sql, params={}):
 
 class Transaction(object):
     def __init__(self):
-        self._conn = current_app.extensions["connction_pool"].getconn()
-        self._conn.set_session(isolation_level=ISOLATION_LEVEL_SERIALIZABLE,
-                               readonly=False)
+        self._conn = checkout(ISOLATION_LEVEL_SERIALIZABLE, readonly=False)
         
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            self._conn.commit()
-        self.close()
+        try:
+            if exc_type is None:
+                self._conn.commit()
+        finally:
+            self.close()
     
     def close(self):
-        self._conn.rollback()
-        current_app.extensions["connction_pool"].putconn(self._conn)
+        checkin(self._conn)
     
     def __getattr__(self, attr):
         return getattr(self._conn, attr)
@@ -79,30 +96,119 @@ class Transaction(object):
 
 
 class Cursor(object):
-    def __init__(self):
-        self._conn = current_app.extensions["connction_pool"].getconn()
-        self._conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ,
-                               readonly=True)
-        self._cur = self._conn.cursor()
+    """ Read only cursor on the request connection. If name is given a
+        server side (named) cursor is created that fetches itersize rows
+        per round trip rather than the whole result set at once. If name
+        is True a unique name is generated.
+    """
+    def __init__(self, name=None, itersize=1000):
+        if name is True:
+            name = f"cursor_{next(_cursor_names)}"
+        self._conn = checkout(ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        self._cur = self._conn.cursor(name=name)
+        if name is not None:
+            self._cur.itersize = itersize
         
     def __enter__(self):
         return self._cur
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            self._conn.commit()
-        self.close()
+        try:
+            if exc_type is None:
+                self._conn.commit()
+        finally:
+            self.close()
     
     def close(self):
-        self._cur.close()
-        self._conn.rollback()
-        current_app.extensions["connction_pool"].putconn(self._conn)
+        try:
+            self._cur.close()
+        finally:
+            checkin(self._conn)
     
     def __getattr__(self, attr):
         return getattr(self._cur, attr)
 
 
 
+def retry_transaction(retries=3, delay=0.05):
+    """ Decorator that re-runs the decorated function if a Transaction within
+        it fails with a serialization failure or deadlock.
+    
+    Transaction runs at SERIALIZABLE therefore concurrent writes to related
+    rows can legitimately fail and succeed when repeated. The function must
+    therefore be safe to call again, ie all its database work must be done
+    within Transactions that will have been rolled back and it must not
+    modify its arguments, which are passed unchanged to every attempt.
+    Retries are delayed with jittered exponential backoff.
+    
+    Args:
+        retries:
+            Maximum number of times to re-run the function.
+        delay:
+            Seconds to wait before the first retry, doubled thereafter.
+    
+    Returns:
+        Decorator.
+    """
+    def decorator(function):
+        name = f"{function.__module__}.{function.__qualname__}"
+        
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            for attempt in range(retries + 1):
+                try:
+                    return function(*args, **kwargs)
+                except TransactionRollbackError as e:
+                    if e.pgcode not in RETRYABLE_PGCODES or attempt == retries:
+                        with _retry_lock:
+                            _retry_counts[name]["failures"] += 1
+                        raise
+                    with _retry_lock:
+                        _retry_counts[name]["retries"] += 1
+                    time.sleep(random.uniform(0, delay * 2 ** attempt))
+                finally:
+                    with _retry_lock:
+                        _retry_counts[name]["attempts"] += 1
+        return wrapper
+    return decorator
+
+
+
+def retry_stats():
+    """ Returns a dict of attempt, retry and failure counts for each function
+        decorated with retry_transaction. Functions with high retry counts
+        are contention hot spots.
+    """
+    with _retry_lock:
+        return {name: dict(counts) for name, counts in _retry_counts.items()}
+
+
+
+def stream_rows(sql, params={}, itersize=1000):
+    """ Generator of the rows returned by sql using a server side cursor.
+    
+    The query is not executed until iteration starts and rows are fetched
+    itersize at a time, therefore a generator built from this may be
+    passed as the body of a table to stream_page and will be consumed with
+    constant memory while the response is being sent.
+    
+    Args:
+        sql:
+            Query to execute.
+        params:
+            Query parameters.
+        itersize:
+            Number of rows to fetch per round trip.
+    
+    Returns:
+        Generator of row tuples.
+    """
+    with Cursor(name=True, itersize=itersize) as cur:
+        cur.execute(sql, params)
+        yield from cur
+
+
+
 def iso8601_to_utc(dt_string):
     """ Convert a string in iso8601 format to a datetime with the timezone set
         to UTC.
@@ -154,9 +260,17 @@ def demonise(cmd):
 
 
 
-def audit_log(cur, action, target, name, keyvals, format_string, *args, users_id=None, ip_address=None):
+def audit_log(cur, action, target, name, keyvals, format_string, *args, users_id=None, ip_address=None, deferred=False):
     """ Log an action into audittrail.
     
+    The audittrail row and all of its auditlink rows are written with a
+    single statement. If deferred is True the write is instead buffered on
+    the connection and every deferred entry in the transaction is written
+    with a single statement immediately before it commits, therefore bulk
+    operations cost one round trip however many actions they log. If the
+    audit sink is enabled the entry is instead handed to it once the
+    transaction has committed.
+    
     Args:
         cur:
             Postgresql cursor object to perform insert with.
@@ -176,30 +290,75 @@ def audit_log(cur, action, target, name, keyvals, format_string, *args, users_id
             id of user performing action. Only needed if action is not performed within request context.
         ip_address:
             ip address of user performing action. Only needed if action is not performed within request context.
+        deferred:
+            Buffer the write until the transaction commits.
+    
+    Returns:
+        None.
+    """
+    entry = (action,
+             target,
+             name,
+             keyvals,
+             format_string,
+             users_id or session["id"],
+             ip_address or request.remote_addr,
+             args)
+    
+    sink = audit_sink()
+    if sink is not None:
+        row = (*entry[:-1], datetime.now(timezone.utc).isoformat(), entry[-1])
+        cur.connection.after_commit(partial(sink.put, "audittrail", row))
+    elif deferred:
+        cur.connection.defer(write_audit_log, entry)
+    else:
+        write_audit_log(cur, [entry])
+
+
+
+def write_audit_log(cur, entries):
+    """ Insert audittrail rows and their auditlink rows in one statement.
+        Ids are drawn from the audittrail sequence up front so that the
+        links can be joined to their trail rows without relying on the
+        order of RETURNING.
+    
+    Args:
+        cur:
+            Postgresql cursor object to perform insert with.
+        entries:
+            List of tuples of (action, target, name, keyvals, format_string,
+            users_id, ip_address, links) where links is a sequence of
+            (tablename, row_id).
     
     Returns:
         None.
     """
-    sql = """INSERT INTO audittrail (action, target, name, keyvals, format_string, users_id, ip_address)
-             VALUES (%(action)s, %(target)s, %(name)s, %(keyvals)s, %(format_string)s, %(users_id)s, %(ip_address)s)
-             RETURNING id;"""
-    values = {"action": action,
-              "target": target,
-              "name": name,
-              "keyvals": keyvals,
-              "format_string": format_string,
-              "users_id": users_id or session["id"],
-              "ip_address": ip_address or request.remote_addr}
-    
-    cur.execute(sql, values)
-    audittrail_id = cur.fetchone()[0]
-    
-    sql = """INSERT INTO auditlink (audittrail_id, tablename, row_id)
-             VALUES (%(audittrail_id)s, %(tablename)s, %(row_id)s);""" 
-    for tablename, row_id in args:
-        cur.execute(sql, {"audittrail_id": audittrail_id,
-                          "tablename": tablename,
-                          "row_id": row_id})
+    encoding = encodings[cur.connection.encoding]
+    trails = []
+    links = []
+    for n, (*trail, entry_links) in enumerate(entries):
+        trails.append(cur.mogrify("(%s, %s, %s, %s, %s, %s, %s, %s)", (n, *trail)).decode(encoding))
+        for tablename, row_id in entry_links:
+            links.append(cur.mogrify("(%s, %s, %s)", (n, tablename, row_id)).decode(encoding))
+    
+    # A CTE containing a volatile function is evaluated once however many
+    # times it is referenced so each entry keeps the same id throughout.
+    entry_sql = f"""entry AS (
+                        SELECT nextval(pg_get_serial_sequence('audittrail', 'id')) AS id, entry.*
+                        FROM (VALUES {", ".join(trails)}) AS entry (n, action, target, name, keyvals, format_string, users_id, ip_address))"""
+    trail_sql = """INSERT INTO audittrail (id, action, target, name, keyvals, format_string, users_id, ip_address)
+                   SELECT id, action, target, name, keyvals::jsonb, format_string, users_id::integer, ip_address::inet
+                   FROM entry"""
+    if links:
+        sql = f"""WITH {entry_sql},
+                  trail AS ({trail_sql})
+                  INSERT INTO auditlink (audittrail_id, tablename, row_id)
+                  SELECT entry.id, link.tablename, link.row_id::integer
+                  FROM entry
+                  JOIN (VALUES {", ".join(links)}) AS link (n, tablename, row_id) ON link.n = entry.n;"""
+    else:
+        sql = f"WITH {entry_sql} {trail_sql};"
+    cur.execute(sql)
 
 
 